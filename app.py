@@ -1,20 +1,47 @@
-from flask import Flask, request, jsonify, render_template
+from flask import (Flask, request, jsonify, render_template, send_file, after_this_request,
+                   Response, stream_with_context, session, g)
 from pinecone_utils import vector_store_manager
-from rag_kernel import run_query, clear_sk_memory, get_chat_history
+from topic_snapshot import export_topic, import_topic
+from embedding_migration import start_reembedding, get_migration_status
+from migration_store import MigrationInProgress
+from blob_store import store_document, extracting, resolve_document, collect_garbage
+from ingestion_pipeline import embed_files_pipelined
+from rag_kernel import run_query, run_query_batch, normalize_batch_item, clear_sk_memory, get_chat_history
+from session_store import prune_sessions
+from profiler import SamplingProfiler, PROFILE_DIR, arm, armed, take_armed, list_profiles
 import os
 import shutil
 import json
+import tempfile
+import uuid
+import hmac
 from helpers import (UPLOAD_FOLDER,
-                     DOC_EXTENSIONS,
+                     EMBEDDING_MODEL,
+                     EMBEDDING_DIMENSION,
+                     QUERY_BATCH_CONCURRENCY,
+                     CHUNK_OVERLAP,
+                     client as openai_client,
                      IMG_EXTENSIONS,
-                     extract_text,
                      generate_gpt4_description,
+                     generate_thumbnail,
+                     thumbnail_path,
+                     file_version,
                      extract_images_from_pdf,
                      extract_images_from_docx,
                      extract_images_from_pptx)
 
 app = Flask(__name__)
-app.secret_key = 'supersecretkey'
+# Session cookies are signed with this key, so every worker and host serving
+# the app must share the same value.
+app.secret_key = os.getenv("FLASK_SECRET_KEY")
+if not app.secret_key:
+    # Fine for `python app.py` during development, but anyone can sign
+    # cookies with the fallback key, so say so everywhere else.
+    app.secret_key = 'supersecretkey'
+    if __name__ != '__main__' and os.getenv("FLASK_DEBUG", "").lower() not in ("1", "true"):
+        print("WARNING: FLASK_SECRET_KEY is not set, so session cookies are signed with a publicly known key "
+              "and can be forged. Set it to a long random value shared by every worker.")
+prune_sessions()
 
 #===Page-Wide Rendering===
 @app.route('/')
@@ -49,6 +76,16 @@ removing pinecone indexes on Pinecone. These methods include
         For deleting an index on pinecone and removing
         its description from the Table of Contents
         index, ensuring total consistency
+
+-   reembed_topic() & reembed_status()
+        For re-embedding a topic with another embedding
+        model or dimension in the background, switching
+        its queries over once the new index is complete.
+
+-   export_topic_snapshot() & import_topic_snapshot()
+        For packing a topic's vectors, description and
+        uploaded files into one archive, and restoring
+        it as a topic elsewhere without any OpenAI calls.
 """
 @app.route('/list_indexes', methods=['GET'])
 def list_indexes():
@@ -88,8 +125,7 @@ def create_index():
     if not index_name or not index_name.islower() or not all(c.isalnum() or c == '-' for c in index_name):
         return jsonify({"error": "Index name must be lowercase, alphanumeric, or contain '-' only."}), 400
     try:
-        vector_store_manager.create_index(index_name)
-        vector_store_manager.upsert_metadata(index_name, description)
+        vector_store_manager.create_index(index_name, description)
         return jsonify({"message": f"Index '{index_name}' created successfully."})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -100,12 +136,83 @@ def delete_index():
     index_name = data.get("index_name")
     if not index_name:
         return jsonify({"error": "Index name is required."}), 400
+    if vector_store_manager.is_migrating(index_name):
+        return jsonify({"error": f"'{index_name}' is being re-embedded; try again once the migration finishes."}), 409
     try:
         vector_store_manager.delete_index(index_name)
         return jsonify({"message": f"Index '{index_name}' deleted successfully."})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/export_topic', methods=['POST'])
+def export_topic_snapshot():
+    data = request.json
+    index_name = data.get("index_name")
+    dtype = data.get("dtype", "float32")
+    if not index_name:
+        return jsonify({"error": "Index name is required."}), 400
+    fd, archive_path = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+
+    @after_this_request
+    def remove_archive(response):
+        response.call_on_close(lambda: os.remove(archive_path))
+        return response
+
+    try:
+        export_topic(index_name, archive_path, dtype)
+        return send_file(archive_path, as_attachment=True, download_name=f"{index_name}.zip")
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/import_topic', methods=['POST'])
+def import_topic_snapshot():
+    index_name = request.form.get('index_name') or None
+    file = request.files.get('file')
+    if not file:
+        return jsonify({"error": "No snapshot file provided."}), 400
+    if index_name and (not index_name.islower() or not all(c.isalnum() or c == '-' for c in index_name)):
+        return jsonify({"error": "Index name must be lowercase, alphanumeric, or contain '-' only."}), 400
+    fd, archive_path = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    try:
+        file.save(archive_path)
+        topic, count = import_topic(archive_path, index_name)
+        return jsonify({"message": f"Imported {count} vectors into '{topic}'."})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        os.remove(archive_path)
+
+@app.route('/reembed_topic', methods=['POST'])
+def reembed_topic():
+    data = request.json
+    index_name = data.get("index_name")
+    if not index_name:
+        return jsonify({"error": "Index name is required."}), 400
+    try:
+        dimension = int(data.get("dimension") or EMBEDDING_DIMENSION)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Dimension must be a whole number."}), 400
+    try:
+        embedding_model = data.get("embedding_model") or EMBEDDING_MODEL
+        start_reembedding(index_name, embedding_model, dimension)
+        return jsonify({"message": f"Re-embedding '{index_name}' with {embedding_model} ({dimension} dimensions) started."}), 202
+    except MigrationInProgress as e:
+        return jsonify({"error": str(e)}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/reembed_status', methods=['POST'])
+def reembed_status():
+    data = request.json
+    index_name = data.get("index_name")
+    if not index_name:
+        return jsonify({"error": "Index name is required."}), 400
+    return jsonify(get_migration_status(index_name))
+
 #===Document Management===
 """
 The following methods are used for managing individual
@@ -118,12 +225,15 @@ a particular topic:
         
 -   upload_document()
         This method takes in a file from the frontend
-        and saves it locally within a directory with
-        the file's name as a subdirectory of the
-        topic it was submitted under. Additionally,
-        pdf's, docx's, and pptx's get an images/
-        subfolder where any images in a document
-        are extracted
+        and saves it once in the blob store, keyed by
+        the hash of its contents, and records a
+        reference to it within a directory with the
+        file's name as a subdirectory of the topic it
+        was submitted under. Additionally, pdf's,
+        docx's, and pptx's get an images/ subfolder
+        where any images in a document are extracted.
+        Re-uploading identical content reuses the
+        stored file, images and descriptions
         
 -   embed_files()
         This method extracts the text of selected
@@ -156,9 +266,14 @@ def list_uploaded_files():
 
     files = os.listdir(folder_path)
     file_info = []
+    try:
+        spec = vector_store_manager.get_topic_spec(index_name)
+    except Exception as e:
+        print(f"Error looking up topic {index_name}: {e}")
+        spec = None
 
     for file_name in files:
-        embedded = vector_store_manager.is_embedded(index_name, file_name)
+        embedded = spec is not None and vector_store_manager.is_embedded(index_name, file_name, spec=spec)
         file_info.append({"name": file_name, "embedded": embedded})
 
     return jsonify({"files": file_info})
@@ -174,30 +289,44 @@ def upload_document():
     if not file:
         return jsonify({"error": "No file provided."}), 400
 
-    topic_dir = os.path.join(UPLOAD_FOLDER, index_name)
-    os.makedirs(topic_dir, exist_ok=True)
-
-    document_dir = os.path.join(topic_dir, file.filename)
-    os.makedirs(document_dir, exist_ok=True)
-    file_path = os.path.join(document_dir, file.filename)
-    file.save(file_path)
+    sha, blob_dir, file_path = store_document(index_name, file)
+    document_dir = os.path.join(UPLOAD_FOLDER, index_name, file.filename)
 
     ext = "." + file.filename.split(".")[-1].lower()
     images_saved = []
 
-    if ext not in IMG_EXTENSIONS:
-        # For docs (PDF/DOCX/PPTX), extract embedded images
-        document_image_dir = os.path.join(document_dir, "images")
-        os.makedirs(document_image_dir, exist_ok=True)
-        if ext.endswith(".pdf"):
-            images_saved = extract_images_from_pdf(document_dir, file_path, document_image_dir)
-        elif ext.endswith(".docx"):
-            images_saved = extract_images_from_docx(document_dir, file_path, document_image_dir)
-        elif ext.endswith(".pptx"):
-            images_saved = extract_images_from_pptx(document_dir, file_path, document_image_dir)
-    else:
+    try:
+        with extracting(index_name, file.filename, sha, blob_dir) as needs_extraction:
+            if ext not in IMG_EXTENSIONS and not needs_extraction:
+                # Identical content was uploaded before, so its images and their
+                # descriptions already sit in the blob.
+                document = resolve_document(index_name, file.filename)
+                if os.path.exists(document["alt_map_path"]):
+                    with open(document["alt_map_path"], "r", encoding="utf-8") as f:
+                        images_saved = [entry.get("path") for entry in json.load(f)]
+                return jsonify({
+                    "message": f"Document '{file.filename}' was already stored; reused it and its {len(images_saved)} images."
+                })
+
+            if ext not in IMG_EXTENSIONS:
+                # For docs (PDF/DOCX/PPTX), extract embedded images into the blob
+                document_image_dir = os.path.join(blob_dir, "images")
+                os.makedirs(document_image_dir, exist_ok=True)
+                if ext.endswith(".pdf"):
+                    images_saved = extract_images_from_pdf(blob_dir, file_path, document_image_dir)
+                elif ext.endswith(".docx"):
+                    images_saved = extract_images_from_docx(blob_dir, file_path, document_image_dir)
+                elif ext.endswith(".pptx"):
+                    images_saved = extract_images_from_pptx(blob_dir, file_path, document_image_dir)
+            elif needs_extraction:
+                generate_thumbnail(file_path)
+    except Exception as e:
+        return jsonify({"error": f"Failed to process '{file.filename}': {str(e)}"}), 500
+
+    if ext in IMG_EXTENSIONS:
         # For standalone images
         images_saved = [file_path]
+        # Descriptions are per topic, so they live next to the topic's reference.
         if user_description:
             alt_map_path = os.path.join(document_dir, "alt_image_map.json")
             with open(alt_map_path, "w", encoding="utf-8") as f:
@@ -216,70 +345,25 @@ def embed_files():
     index_name = data.get("index_name")
     files_to_embed = list(data.get("files", []))
     chunk_size = int(data.get("chunk_size", 500))
+    overlap = int(data.get("overlap", CHUNK_OVERLAP))
 
     if not index_name or not files_to_embed:
         return jsonify({"error": "Index name and files are required."}), 400
 
-    topic_path = os.path.join(UPLOAD_FOLDER, index_name)
-    total_text_vectors = 0
-    total_image_vectors = 0
-
-    for file_name in files_to_embed:
-        file_dir = os.path.join(topic_path, file_name)
-        file_path = os.path.join(file_dir, file_name)
-        ext = "." + file_name.split(".")[-1].lower()
-
-        # === 🟢 First: TEXT-BASED EMBEDDINGS ===
-        if ext in DOC_EXTENSIONS:
-            try:
-                text_chunks = extract_text(file_path, chunk_size)
-                total_text_vectors += len(text_chunks)
-                file_paths = [file_path] * len(text_chunks)
-
-                if text_chunks:
-                    vector_store_manager.upsert_vectors(
-                        index_name,
-                        src_doc=file_name,
-                        file_paths=file_paths,
-                        chunks=text_chunks,
-                        embed_type="text"
-                    )
-            except Exception as e:
-                print(f"Error extracting text from {file_name}: {e}")
-
-        # === 🟢 Second: IMAGE-BASED EMBEDDINGS via alt_image_map.json ===
-        alt_map_path = os.path.join(file_dir, "alt_image_map.json")
-        if os.path.exists(alt_map_path):
-            try:
-                with open(alt_map_path, "r", encoding="utf-8") as f:
-                    alt_images_info = json.load(f)
-
-                image_paths = []
-                image_descriptions = []
-
-                for entry in alt_images_info:
-                    img_path = entry.get("path")
-                    alt_text = entry.get("alt_text")
-                    if os.path.exists(img_path) and alt_text:
-                        image_paths.append(img_path)
-                        image_descriptions.append(alt_text)
-
-                if image_descriptions:
-                    vector_store_manager.upsert_vectors(
-                        index_name,
-                        src_doc=file_name,
-                        file_paths=image_paths,
-                        chunks=image_descriptions,
-                        embed_type="image"
-                    )
-                    total_image_vectors += len(image_descriptions)
-
-            except Exception as e:
-                print(f"Error reading alt_image_map.json for {file_name}: {e}")
+    try:
+        total_text_vectors, total_image_vectors, errors, stats = embed_files_pipelined(
+            index_name, files_to_embed, chunk_size, overlap
+        )
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-    return jsonify({
-        "message": f"Embedding complete: {total_text_vectors} text chunks and {total_image_vectors} images processed."
-    })
+    failed_files = sorted({error["file_name"] for error in errors})
+    message = f"Embedding complete: {total_text_vectors} text chunks and {total_image_vectors} images processed."
+    if failed_files:
+        message += f" Failed for: {', '.join(failed_files)}."
+    # Only report a failure outright when nothing could be embedded at all.
+    status = 500 if errors and len(failed_files) == len(set(files_to_embed)) else 200
+    return jsonify({"message": message, "errors": errors, "stats": stats}), status
 
 @app.route('/unembed_files', methods=['POST'])
 def unembed_files():
@@ -288,10 +372,17 @@ def unembed_files():
     files_to_unembed = list(data.get("files", []))
     if not index_name or not files_to_unembed:
         return jsonify({"error": "Index name and files to unembed are required."}), 400
+    if vector_store_manager.is_migrating(index_name):
+        return jsonify({"error": f"'{index_name}' is being re-embedded; try again once the migration finishes."}), 409
+
+    try:
+        spec = vector_store_manager.get_topic_spec(index_name)
+    except Exception as e:
+        return jsonify({"error": f"Failed to look up '{index_name}': {str(e)}"}), 500
 
     for file_name in files_to_unembed:
         try:
-            vector_store_manager.delete_vectors_by_source(index_name, file_name)
+            vector_store_manager.delete_vectors_by_source(index_name, file_name, spec=spec)
         except Exception as e:
             return jsonify({"error": f"Failed to unembed '{file_name}': {str(e)}"}), 500
 
@@ -304,12 +395,17 @@ def delete_files():
     files_to_delete = data.get("files", [])
     if not index_name or not files_to_delete:
         return jsonify({"error": "Index name and files to delete are required."}), 400
+    if vector_store_manager.is_migrating(index_name):
+        return jsonify({"error": f"'{index_name}' is being re-embedded; try again once the migration finishes."}), 409
+
+    spec = vector_store_manager.get_topic_spec(index_name)
 
     for file_name in files_to_delete:
         document_dir = os.path.join(UPLOAD_FOLDER, index_name, file_name)
         if os.path.exists(document_dir):
             shutil.rmtree(document_dir)
-        vector_store_manager.delete_vectors_by_source(index_name, file_name)
+        vector_store_manager.delete_vectors_by_source(index_name, file_name, spec=spec)
+    collect_garbage()
 
     return jsonify({"message": f"Selected files and associated data have been deleted from '{index_name}'."})
 
@@ -318,7 +414,18 @@ def delete_files():
 For getting questions from the frontend, generating
 responses to the questions using semantic kernel,
 and clearing the chat history when we are finished.
+Batches of independent questions (e.g. an evaluation
+set) can be answered concurrently with query_batch().
+Each browser session has its own history, kept in
+session_store so any worker can continue it.
 """
+def current_session_id():
+    """Returns the id of the browser's conversation, assigning one on its first request."""
+    if "session_id" not in session:
+        session["session_id"] = uuid.uuid4().hex
+        session.permanent = True
+    return session["session_id"]
+
 @app.route('/query', methods=['POST'])
 def query():
     data = request.json
@@ -327,29 +434,163 @@ def query():
     use_general_knowledge = data.get("use_general_knowledge", True)
     if not query_text:
         return jsonify({"error": "Query text is required."}), 400
-    response = run_query(query_text, topics, use_general_knowledge)
-    return jsonify({"response": str(response)})
+    response, context_stats = run_query(query_text, topics, use_general_knowledge, session_id=current_session_id())
+    return jsonify({"response": str(response), "context_stats": context_stats})
+
+@app.route('/query_batch', methods=['POST'])
+def query_batch():
+    """
+    Answers many independent questions (no chat history) concurrently.
+    Results are streamed back as newline-delimited JSON in the order they finish.
+    max_concurrency may lower, but never raise, QUERY_BATCH_CONCURRENCY.
+    """
+    data = request.json
+    queries = data.get("queries")
+    if not isinstance(queries, list) or not queries:
+        return jsonify({"error": "A list of queries, each with query text, is required."}), 400
+    for position, item in enumerate(queries):
+        try:
+            normalize_batch_item(item)
+        except ValueError as e:
+            return jsonify({"error": f"Query {position}: {e}"}), 400
+    try:
+        max_concurrency = min(int(data.get("max_concurrency", QUERY_BATCH_CONCURRENCY)), QUERY_BATCH_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({"error": "max_concurrency must be a whole number."}), 400
+    if max_concurrency < 1:
+        return jsonify({"error": "max_concurrency must be at least 1."}), 400
 
-from flask import send_from_directory
+    def generate():
+        for result in run_query_batch(queries, max_concurrency):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+from flask import send_from_directory, abort
+from werkzeug.security import safe_join
+import mimetypes
 import urllib.parse
-import os
-from helpers import UPLOAD_FOLDER
+
+"""
+Uploaded files are served with ETag/Last-Modified validation and HTTP range
+support. Links generated for chat answers carry a `v` version token, so
+those responses may be cached for good; `variant=thumb` serves the image's
+thumbnail when one was generated. With FILE_DELIVERY set to "x-accel"
+(nginx) or "x-sendfile" (Apache/lighttpd) the front proxy sends the file
+instead of a Python worker.
+"""
+FILE_DELIVERY = os.getenv("FILE_DELIVERY", "flask")
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX", "/protected-uploads/")
+FILE_MAX_AGE = int(os.getenv("FILE_MAX_AGE", 3600))
+VERSIONED_FILE_MAX_AGE = 365 * 24 * 3600
+app.config["USE_X_SENDFILE"] = FILE_DELIVERY == "x-sendfile"
 
 @app.route(f'/{UPLOAD_FOLDER}/<path:filename>')
 def serve_uploaded_file(filename):
     safe_path = urllib.parse.unquote(filename)
-    return send_from_directory(UPLOAD_FOLDER, safe_path)
+    full_path = safe_join(UPLOAD_FOLDER, safe_path)
+    if full_path is None or not os.path.isfile(full_path):
+        abort(404)
+    # Only a token matching the file's current version may be cached for good;
+    # a stale or made-up one would pin an outdated copy in the browser.
+    versioned = request.args.get("v") == file_version(full_path)
+    if request.args.get("variant") == "thumb" and os.path.isfile(thumbnail_path(full_path)):
+        full_path = thumbnail_path(full_path)
+        safe_path = os.path.relpath(full_path, UPLOAD_FOLDER).replace("\\", "/")
+
+    max_age = VERSIONED_FILE_MAX_AGE if versioned else FILE_MAX_AGE
+
+    if FILE_DELIVERY == "x-accel":
+        response = Response(mimetype=mimetypes.guess_type(full_path)[0] or "application/octet-stream")
+        response.headers["X-Accel-Redirect"] = X_ACCEL_PREFIX + urllib.parse.quote(safe_path)
+    else:
+        response = send_from_directory(UPLOAD_FOLDER, safe_path, max_age=max_age, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if versioned:
+        response.cache_control.immutable = True
+    return response
 
 @app.route('/load_conversation', methods=['GET'])
 def get_chat_history_api():
-    history = get_chat_history()
+    history = get_chat_history(current_session_id())
     return jsonify({"chat_history": history})
 
 @app.route('/clear_chat', methods=['POST'])
 def clear_chat():
-    clear_sk_memory()
+    clear_sk_memory(current_session_id())
     return jsonify({"message": "Chat history cleared."})
 
+@app.route('/openai_metrics', methods=['GET'])
+def openai_metrics():
+    """Request, retry and throttling counters for the shared OpenAI client."""
+    return jsonify(openai_client.metrics())
+
+#===Profiling===
+"""
+Requests to the endpoints below can be profiled on demand, either by arming
+a number of profiles through /admin/profile or by sending "X-Profile: 1"
+with a request. Both require the ADMIN_TOKEN in an X-Admin-Token header;
+without an ADMIN_TOKEN configured, profiling is unavailable. Saved profiles
+are listed at /admin/profile and downloaded from /admin/profiles/<name>.
+"""
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILED_ENDPOINTS = ["query", "embed_files"]
+
+def is_admin():
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+@app.before_request
+def start_profile():
+    if request.endpoint not in PROFILED_ENDPOINTS:
+        return
+    if (request.headers.get("X-Profile") == "1" and is_admin()) or take_armed(request.endpoint):
+        g.profiler = SamplingProfiler().start()
+
+@app.after_request
+def save_profile(response):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        file_name = profiler.stop().save(request.endpoint)
+        print(f"Saved profile {file_name} ({profiler.samples} samples)")
+        response.headers["X-Profile-File"] = file_name
+    return response
+
+@app.teardown_request
+def discard_profile(exception):
+    # Stops the sampler if the request failed before after_request ran.
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    if not is_admin():
+        return jsonify({"error": "Admin token required."}), 403
+    if request.method == 'POST':
+        data = request.json or {}
+        endpoints = data.get("endpoints", PROFILED_ENDPOINTS)
+        if not isinstance(endpoints, list) or not all(isinstance(endpoint, str) for endpoint in endpoints):
+            return jsonify({"error": "endpoints must be a list of endpoint names."}), 400
+        unknown = [endpoint for endpoint in endpoints if endpoint not in PROFILED_ENDPOINTS]
+        if unknown:
+            return jsonify({"error": f"Cannot profile {unknown}; choose from {PROFILED_ENDPOINTS}."}), 400
+        try:
+            count = int(data.get("requests", 1))
+        except (TypeError, ValueError):
+            return jsonify({"error": "requests must be a whole number."}), 400
+        if count < 0:
+            return jsonify({"error": "requests cannot be negative."}), 400
+        arm(endpoints, count)
+    return jsonify({"armed": armed(), "profiles": list_profiles()})
+
+@app.route('/admin/profiles/<path:name>', methods=['GET'])
+def download_profile(name):
+    if not is_admin():
+        return jsonify({"error": "Admin token required."}), 403
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True, mimetype="text/plain")
+
 # === To start the application ===
 if __name__ == '__main__':
     app.run("0.0.0.0", debug=True)
@@ -0,0 +1,15 @@
+"""
+Small helpers shared by the command-line benchmarks (load_test.py and
+retrieval_sweep.py).
+"""
+
+
+def percentile(values, fraction):
+    """The value below which `fraction` of `values` fall (nearest rank), or 0.0 for no values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def parse_ints(value):
+    """Parses a comma-separated list of integers such as "1,4,16", as given on the command line."""
+    return [int(part) for part in value.split(",") if part.strip()]
@@ -0,0 +1,325 @@
+"""
+Content-addressed storage for uploaded files.
+
+Each distinct file is stored once, under the SHA-256 of its contents, along
+with everything derived from it: extracted images, their descriptions
+(alt_image_map.json), the extracted text and cached embeddings. Topics only
+hold a small reference to the blob, so uploading the same document to
+several topics, or uploading it again, reuses all of that work.
+
+    UPLOAD_FOLDER/_blobs/<sha256>/<file name>            the uploaded file
+    UPLOAD_FOLDER/_blobs/<sha256>/images/...             extracted images
+    UPLOAD_FOLDER/_blobs/<sha256>/alt_image_map.json     image descriptions
+    UPLOAD_FOLDER/_blobs/<sha256>/text.txt               extracted text
+    UPLOAD_FOLDER/_blobs/<sha256>/embeddings/...         embeddings by model, one file per batch
+    UPLOAD_FOLDER/_blobs/<sha256>/.complete              written once extraction has succeeded
+    UPLOAD_FOLDER/<topic>/<file name>/reference.json     the topic's reference
+
+Documents uploaded before this layout existed live entirely in their topic
+directory and keep working through resolve_document().
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the development server runs in a single process anyway.
+    fcntl = None
+
+from helpers import UPLOAD_FOLDER, get_embeddings
+
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, "_blobs")
+REFERENCE_FILE = "reference.json"
+ALT_MAP_FILE = "alt_image_map.json"
+TEXT_CACHE_FILE = "text.txt"
+HASH_BLOCK_SIZE = 1024 * 1024
+EMBED_BATCH_SIZE = 100
+
+BLOB_LOCK_FILE = os.path.join(BLOB_FOLDER, ".lock")
+# Written once a blob's images and descriptions have all been extracted.
+COMPLETE_FILE = ".complete"
+EXTRACT_LOCK_FILE = ".extract.lock"
+# Files in a blob directory that are not the uploaded document itself.
+BLOB_SIDE_FILES = (ALT_MAP_FILE, TEXT_CACHE_FILE, COMPLETE_FILE, EXTRACT_LOCK_FILE)
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _file_lock(path):
+    """
+    An exclusive lock named after `path`, held across threads and, through an
+    flock on that file, across every worker process sharing UPLOAD_FOLDER.
+    """
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(path, threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _blob_lock():
+    """Held while blobs are linked into topics or garbage collected."""
+    return _file_lock(BLOB_LOCK_FILE)
+
+
+def store_document(index_name, file):
+    """
+    Saves an uploaded file (a werkzeug FileStorage) into the blob store and
+    links it into the topic. Returns (sha256, blob_dir, blob_file_path).
+    """
+    os.makedirs(BLOB_FOLDER, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=BLOB_FOLDER)
+    with os.fdopen(fd, "wb") as f:
+        while True:
+            block = file.stream.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            f.write(block)
+    sha = digest.hexdigest()
+    blob_dir = os.path.join(BLOB_FOLDER, sha)
+
+    # Linking under the lock keeps collect_garbage() from removing a blob
+    # between it being stored and being referenced.
+    with _blob_lock():
+        blob_path = find_blob_file(blob_dir)
+        if blob_path is None:
+            os.makedirs(blob_dir, exist_ok=True)
+            blob_path = os.path.join(blob_dir, file.filename)
+            os.replace(temp_path, blob_path)
+        else:
+            os.remove(temp_path)
+        link_document(index_name, file.filename, sha, blob_path)
+    return sha, blob_dir, blob_path
+
+
+def find_blob_file(blob_dir):
+    if not os.path.isdir(blob_dir):
+        return None
+    for entry in os.listdir(blob_dir):
+        path = os.path.join(blob_dir, entry)
+        if os.path.isfile(path) and entry not in BLOB_SIDE_FILES:
+            return path
+    return None
+
+
+def link_document(index_name, file_name, sha, blob_path):
+    """Records that a topic's file `file_name` refers to the given blob."""
+    document_dir = os.path.join(UPLOAD_FOLDER, index_name, file_name)
+    # A new upload replaces whatever the topic held under this name before.
+    if os.path.exists(document_dir):
+        shutil.rmtree(document_dir)
+    os.makedirs(document_dir, exist_ok=True)
+    with open(os.path.join(document_dir, REFERENCE_FILE), "w", encoding="utf-8") as f:
+        json.dump({"sha256": sha, "path": blob_path}, f, indent=4)
+    return document_dir
+
+
+def unlink_document(index_name, file_name, sha):
+    """Removes a topic's file if it still refers to the given blob."""
+    document_dir = os.path.join(UPLOAD_FOLDER, index_name, file_name)
+    reference_path = os.path.join(document_dir, REFERENCE_FILE)
+    with _blob_lock():
+        if not os.path.exists(reference_path):
+            return
+        with open(reference_path, "r", encoding="utf-8") as f:
+            if json.load(f)["sha256"] != sha:
+                return
+        shutil.rmtree(document_dir)
+
+
+@contextmanager
+def extracting(index_name, file_name, sha, blob_dir):
+    """
+    Held while a stored document's images and their descriptions are
+    extracted into its blob; yields whether that still has to be done.
+    Uploads of the same content wait for each other rather than reuse a blob
+    that is only half extracted. When the block completes, the blob is marked
+    complete. If it raises, the topic's link is removed and the blob deleted
+    (unless another topic uses it), so the next upload extracts it afresh.
+    """
+    complete_path = os.path.join(blob_dir, COMPLETE_FILE)
+    needs_extraction = False
+    try:
+        with _file_lock(os.path.join(blob_dir, EXTRACT_LOCK_FILE)):
+            needs_extraction = not os.path.exists(complete_path)
+            if needs_extraction:
+                # Left over from an extraction that failed part way.
+                shutil.rmtree(os.path.join(blob_dir, "images"), ignore_errors=True)
+                if os.path.exists(os.path.join(blob_dir, ALT_MAP_FILE)):
+                    os.remove(os.path.join(blob_dir, ALT_MAP_FILE))
+            yield needs_extraction
+            if needs_extraction:
+                with open(complete_path, "w", encoding="utf-8"):
+                    pass
+    except Exception:
+        if needs_extraction:
+            unlink_document(index_name, file_name, sha)
+            collect_garbage()
+        raise
+
+
+def resolve_document(index_name, file_name):
+    """
+    Returns where a topic's file lives: a dictionary with the document's
+    `file_path`, the `alt_map_path` to read image descriptions from (a
+    topic-specific map takes precedence over the blob's), its topic
+    `document_dir` and its `blob_dir` (None for the legacy layout).
+    """
+    document_dir = os.path.join(UPLOAD_FOLDER, index_name, file_name)
+    reference_path = os.path.join(document_dir, REFERENCE_FILE)
+    topic_alt_map = os.path.join(document_dir, ALT_MAP_FILE)
+    if not os.path.exists(reference_path):
+        return {"file_path": os.path.join(document_dir, file_name), "alt_map_path": topic_alt_map,
+                "document_dir": document_dir, "blob_dir": None}
+
+    with open(reference_path, "r", encoding="utf-8") as f:
+        reference = json.load(f)
+    blob_dir = os.path.join(BLOB_FOLDER, reference["sha256"])
+    return {
+        "file_path": reference["path"],
+        "alt_map_path": topic_alt_map if os.path.exists(topic_alt_map) else os.path.join(blob_dir, ALT_MAP_FILE),
+        "document_dir": document_dir,
+        "blob_dir": blob_dir,
+    }
+
+
+def cached_text(document, extract):
+    """Returns the document's full text, extracting it with `extract(file_path)` only once per blob."""
+    if document["blob_dir"] is None:
+        return extract(document["file_path"])
+    cache_path = os.path.join(document["blob_dir"], TEXT_CACHE_FILE)
+    if os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return f.read()
+    text = extract(document["file_path"])
+    with open(cache_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return text
+
+
+class EmbeddingCache:
+    """
+    A blob's cached embeddings for one model and dimension, loaded once and
+    then kept in memory, so a pipeline run embedding a document batch by
+    batch reads the cache only once. Every batch of new embeddings is written
+    to a file of its own, named after its contents, and moved into place with
+    os.replace(). Nothing is ever rewritten, so writers need no lock and
+    readers never see a partly written file.
+
+        <blob_dir>/embeddings/<model>-<dimension>/<sha256>.json
+    """
+
+    def __init__(self, blob_dir, embedding_model, dimension):
+        self.embedding_model = embedding_model
+        self.dimension = dimension
+        self.cache_dir = None if blob_dir is None else os.path.join(
+            blob_dir, "embeddings", f"{embedding_model}-{dimension}")
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def _load(self):
+        entries = {}
+        # Embeddings cached before they were split into batch files.
+        legacy_path = self.cache_dir + ".json"
+        paths = [legacy_path] if os.path.exists(legacy_path) else []
+        if os.path.isdir(self.cache_dir):
+            paths += [os.path.join(self.cache_dir, name) for name in sorted(os.listdir(self.cache_dir))
+                      if name.endswith(".json")]
+        for path in paths:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entries.update(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable embedding cache {path}: {e}")
+        return entries
+
+    def _save(self, new_entries):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        name = hashlib.sha256("".join(sorted(new_entries)).encode("utf-8")).hexdigest()
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(new_entries, f)
+        os.replace(temp_path, os.path.join(self.cache_dir, f"{name}.json"))
+
+    def embed(self, texts):
+        """Embeds texts, reusing any embedding the blob already has for the same text."""
+        if self.cache_dir is None:
+            return _embed_in_batches(texts, self.embedding_model, self.dimension)
+        with self.lock:
+            if self.entries is None:
+                self.entries = self._load()
+            keys = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+            missing = {key: text for key, text in zip(keys, texts) if key not in self.entries}
+        if missing:
+            embeddings = _embed_in_batches(list(missing.values()), self.embedding_model, self.dimension)
+            new_entries = dict(zip(missing, embeddings))
+            self._save(new_entries)
+            with self.lock:
+                self.entries.update(new_entries)
+        with self.lock:
+            return [self.entries[key] for key in keys]
+
+
+def cached_embeddings(blob_dir, texts, embedding_model, dimension):
+    """
+    Embeds texts, reusing any embedding this blob already has for the same
+    text, model and dimension, so embedding the same file into another topic
+    costs no OpenAI calls. Use an EmbeddingCache directly to embed a document
+    in several batches.
+    """
+    return EmbeddingCache(blob_dir, embedding_model, dimension).embed(texts)
+
+
+def _embed_in_batches(texts, embedding_model, dimension):
+    embeddings = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        embeddings += get_embeddings(texts[start:start + EMBED_BATCH_SIZE], embedding_model, dimension)
+    return embeddings
+
+
+def referenced_blobs():
+    """Returns the set of blob hashes referenced by any topic."""
+    shas = set()
+    for index_name in os.listdir(UPLOAD_FOLDER):
+        topic_dir = os.path.join(UPLOAD_FOLDER, index_name)
+        if index_name == os.path.basename(BLOB_FOLDER) or not os.path.isdir(topic_dir):
+            continue
+        for file_name in os.listdir(topic_dir):
+            reference_path = os.path.join(topic_dir, file_name, REFERENCE_FILE)
+            if os.path.exists(reference_path):
+                with open(reference_path, "r", encoding="utf-8") as f:
+                    shas.add(json.load(f)["sha256"])
+    return shas
+
+
+def collect_garbage():
+    """Deletes blobs that no topic refers to any more."""
+    if not os.path.isdir(BLOB_FOLDER):
+        return 0
+    with _blob_lock():
+        live = referenced_blobs()
+        removed = 0
+        for sha in os.listdir(BLOB_FOLDER):
+            blob_dir = os.path.join(BLOB_FOLDER, sha)
+            if sha not in live and os.path.isdir(blob_dir):
+                shutil.rmtree(blob_dir)
+                removed += 1
+    return removed
@@ -0,0 +1,190 @@
+"""
+Packs retrieved chunks into a prompt-sized context.
+
+chunk_text() produces heavily overlapping windows (500 words with a
+250-word overlap by default), so the top results of a query often repeat
+the same passage two or three times. pack_context() stitches overlapping
+chunks from the same source back into a single passage, drops
+near-duplicates, and then fills a token budget in order of relevance.
+"""
+
+# Rough size of a token in characters for English prose; good enough for
+# budgeting without pulling in a tokenizer.
+CHARS_PER_TOKEN = 4
+SHINGLE_SIZE = 5
+DUPLICATE_THRESHOLD = 0.9
+# Chunks are only stitched together when they are neighbouring windows of the
+# same document that share at least this many words; a shorter match (say a
+# single "the") is a coincidence, not an overlap.
+MIN_MERGE_OVERLAP = 20
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1 if text else 0
+
+
+def _word_overlap(left, right):
+    """Returns the length of the longest suffix of `left` that is a prefix of `right`."""
+    if not left or not right:
+        return 0
+    first = right[0]
+    start = max(0, len(left) - len(right))
+    for i in range(start, len(left)):
+        if left[i] == first and left[i:] == right[:len(left) - i]:
+            return len(left) - i
+    return 0
+
+
+def _shingles(words):
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def _adjacent(first, second):
+    """Whether `second` is the window right after `first` (or the order is unknown)."""
+    if first["first_index"] is None or second["first_index"] is None:
+        return True
+    return second["first_index"] == first["last_index"] + 1
+
+
+def _merge_group(blocks):
+    """Merges blocks from one source that are neighbouring, overlapping windows."""
+    pending = sorted(blocks, key=lambda b: b["first_index"] if b["first_index"] is not None else 0)
+    merged = []
+    while pending:
+        block = pending.pop(0)
+        for target in merged:
+            # Without chunk indexes the order is unknown, so both are tried.
+            orders = [(_word_overlap(first["words"], second["words"]), first, second)
+                      for first, second in ((target, block), (block, target)) if _adjacent(first, second)]
+            if not orders:
+                continue
+            overlap, first, second = max(orders, key=lambda order: order[0])
+            if overlap < MIN_MERGE_OVERLAP:
+                continue
+            # Word offsets of the second window's members move past the first window.
+            shift = len(first["words"]) - overlap
+            spans = first["spans"] + [{**span, "start": span["start"] + shift, "end": span["end"] + shift}
+                                      for span in second["spans"]]
+            merged.remove(target)
+            # The longer passage may now reach blocks that were kept apart before.
+            pending.insert(0, {
+                **target,
+                "words": first["words"] + second["words"][overlap:],
+                "spans": spans,
+                "first_index": first["first_index"],
+                "last_index": second["last_index"],
+                "score": max(target["score"], block["score"]),
+                "members": target["members"] + block["members"],
+                "position": min(target["position"], block["position"]),
+            })
+            break
+        else:
+            merged.append(block)
+    return merged
+
+
+def _trim_to_budget(block, max_chars):
+    """Cuts a block down to `max_chars`, keeping as much as possible of its best-scoring member."""
+    words = block["words"]
+    best = max(block["spans"], key=lambda span: span["score"])
+    start = end = best["start"]
+    length = -1
+
+    def fits(word):
+        return length + len(word) + 1 <= max_chars
+
+    while end < best["end"] and fits(words[end]):
+        length += len(words[end]) + 1
+        end += 1
+    # Whatever budget is left goes to the surrounding words on both sides.
+    growing = True
+    while growing:
+        growing = False
+        if end < len(words) and fits(words[end]):
+            length += len(words[end]) + 1
+            end += 1
+            growing = True
+        if start > 0 and fits(words[start - 1]):
+            length += len(words[start - 1]) + 1
+            start -= 1
+            growing = True
+    return " ".join(words[start:end]) or " ".join(words)[:max_chars]
+
+
+def pack_context(chunks, token_budget):
+    """
+    Merges, de-duplicates and budgets a list of retrieved chunk metadata
+    dictionaries (as returned by query_at_index). Returns the packed list,
+    best scoring first, along with a dictionary of packing statistics.
+    """
+    input_tokens = sum(estimate_tokens(chunk.get("content", "")) for chunk in chunks)
+
+    groups = {}
+    passthrough = []
+    for position, chunk in enumerate(chunks):
+        words = chunk.get("content", "").split()
+        score = chunk.get("score") or 0.0
+        block = {
+            "words": words,
+            "score": score,
+            "first_index": chunk.get("chunk_index"),
+            "last_index": chunk.get("chunk_index"),
+            "spans": [{"start": 0, "end": len(words), "score": score}],
+            "members": 1,
+            "position": position,
+            "metadata": chunk,
+        }
+        if chunk.get("type", "text") == "text":
+            groups.setdefault((chunk.get("source"), chunk.get("file_path")), []).append(block)
+        else:
+            passthrough.append(block)
+
+    blocks = passthrough
+    for group in groups.values():
+        blocks += _merge_group(group)
+    merged_chunks = sum(block["members"] - 1 for block in blocks)
+
+    # Retrieval order is the tie-breaker so unscored results keep their rank.
+    blocks.sort(key=lambda b: (-b["score"], b["position"]))
+    unique = []
+    for block in blocks:
+        shingles = _shingles(block["words"])
+        if any(_similarity(shingles, kept["shingles"]) >= DUPLICATE_THRESHOLD for kept in unique):
+            continue
+        block["shingles"] = shingles
+        unique.append(block)
+    dropped_duplicates = len(blocks) - len(unique)
+
+    packed = []
+    packed_tokens = 0
+    for block in unique:
+        content = " ".join(block["words"])
+        tokens = estimate_tokens(content)
+        if packed_tokens + tokens > token_budget:
+            if packed:
+                continue
+            # Always keep the best block, trimmed to the budget around its best chunk.
+            content = _trim_to_budget(block, token_budget * CHARS_PER_TOKEN)
+            tokens = estimate_tokens(content)
+        packed.append({**block["metadata"], "content": content, "score": block["score"]})
+        packed_tokens += tokens
+
+    stats = {
+        "chunks_in": len(chunks),
+        "chunks_out": len(packed),
+        "merged_chunks": merged_chunks,
+        "dropped_duplicates": dropped_duplicates,
+        "dropped_over_budget": len(unique) - len(packed),
+        "input_tokens": input_tokens,
+        "packed_tokens": packed_tokens,
+        "tokens_saved": max(0, input_tokens - packed_tokens),
+    }
+    return packed, stats
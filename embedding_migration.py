@@ -0,0 +1,124 @@
+"""
+Re-embeds a topic with a different embedding model or dimension.
+
+The topic's chunks are re-embedded from the text stored in their metadata
+into a brand new index, while queries keep using the old one. Once every
+vector has been copied, the topic's table-of-contents entry is pointed at
+the new index in a single metadata update and the old index is deleted.
+While it runs, the topic is claimed in migration_store, so every worker
+refuses to add or delete its vectors until the switch is done.
+
+Only available for topics with their own index; the shared index has a
+single dimension for all of its topics.
+
+Usage:
+    python embedding_migration.py <topic> [--model text-embedding-3-small] [--dimension 512]
+"""
+import argparse
+import threading
+import time
+
+import migration_store
+from helpers import EMBEDDING_MODEL, EMBEDDING_DIMENSION, get_embeddings, validate_embedding_settings
+from pinecone_utils import vector_store_manager
+
+EMBED_BATCH_SIZE = 100
+# Pinecone index names are limited to 45 characters.
+MAX_INDEX_NAME_LENGTH = 45
+
+
+def get_migration_status(topic):
+    return migration_store.get_status(topic)
+
+
+def _new_index_name(topic, dimension):
+    suffix = f"-{dimension}-{int(time.time()):x}"
+    return topic[:MAX_INDEX_NAME_LENGTH - len(suffix)].rstrip("-") + suffix
+
+
+def _claim_topic(topic, embedding_model, dimension):
+    """Checks the request and claims the topic in the shared migration store. Returns (old_spec, new_spec)."""
+    manager = vector_store_manager
+    validate_embedding_settings(embedding_model, dimension)
+    old_spec = manager.get_topic_spec(topic)
+    if manager.in_shared_index(old_spec):
+        raise ValueError("Topics in the shared index cannot be re-embedded individually.")
+    new_spec = {"index": _new_index_name(topic, dimension), "embedding_model": embedding_model, "dimension": dimension}
+    if not migration_store.claim(topic, copied=0, total=0, error=None, started=time.time(), finished=None,
+                                 **{f"new_{key}": value for key, value in new_spec.items()}):
+        raise migration_store.MigrationInProgress(f"'{topic}' is already being re-embedded.")
+    return old_spec, new_spec
+
+
+def _migrate(topic, old_spec, new_spec):
+    manager = vector_store_manager
+    try:
+        source = manager.pc.Index(old_spec["index"])
+        ids = manager.list_vector_ids(source)
+        migration_store.update(topic, total=len(ids))
+
+        manager.create_physical_index(new_spec["index"], new_spec["dimension"])
+        target = manager.pc.Index(new_spec["index"])
+        copied = 0
+        # Vectors are fetched a batch at a time so large topics never sit in memory at once.
+        for start in range(0, len(ids), EMBED_BATCH_SIZE):
+            batch = list(manager.fetch_vectors(source, ids[start:start + EMBED_BATCH_SIZE]))
+            embeddings = get_embeddings([metadata.get("content", "") for _, _, metadata in batch],
+                                        new_spec["embedding_model"], new_spec["dimension"])
+            target.upsert(vectors=[
+                {"id": vector_id, "values": embedding, "metadata": metadata}
+                for (vector_id, _, metadata), embedding in zip(batch, embeddings)
+            ], namespace="docs")
+            copied += len(batch)
+            migration_store.update(topic, copied=copied)
+
+        manager.switch_topic_spec(topic, new_spec)
+        manager.pc.delete_index(old_spec["index"])
+        migration_store.update(topic, state="done", finished=time.time())
+    except Exception as e:
+        try:
+            if manager.get_topic_spec(topic)["index"] != new_spec["index"] and \
+                    new_spec["index"] in manager.pc.list_indexes().names():
+                manager.pc.delete_index(new_spec["index"])
+        finally:
+            # Always release the claim, or the topic stays locked until it goes stale.
+            migration_store.update(topic, state="failed", error=str(e), finished=time.time())
+        raise
+
+
+def reembed_topic(topic, embedding_model=EMBEDDING_MODEL, dimension=EMBEDDING_DIMENSION):
+    old_spec, new_spec = _claim_topic(topic, embedding_model, dimension)
+    _migrate(topic, old_spec, new_spec)
+
+
+def start_reembedding(topic, embedding_model=EMBEDDING_MODEL, dimension=EMBEDDING_DIMENSION):
+    """
+    Claims the topic, then re-embeds it on a background thread; progress is
+    reported by get_migration_status. Raises if the topic cannot be claimed.
+    """
+    old_spec, new_spec = _claim_topic(topic, embedding_model, dimension)
+
+    def run():
+        try:
+            _migrate(topic, old_spec, new_spec)
+        except Exception as e:
+            print(f"Re-embedding '{topic}' failed: {e}")
+
+    thread = threading.Thread(target=run, name=f"reembed-{topic}", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embed a topic into a new index and switch over to it.")
+    parser.add_argument("topic")
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--dimension", type=int, default=EMBEDDING_DIMENSION)
+    args = parser.parse_args()
+    reembed_topic(args.topic, args.model, args.dimension)
+    status = get_migration_status(args.topic)
+    print(f"Re-embedded {status['copied']} vectors of '{args.topic}' into '{status['new_index']}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,83 @@
 from openai import OpenAI
+from openai_limiter import RateLimitedOpenAI
 from dotenv import load_dotenv
 import os
 import base64
+import io
 from PyPDF2 import PdfReader
 from docx import Document
 from pptx import Presentation
 from pptx.enum.shapes import MSO_SHAPE_TYPE
 from pptx.oxml.ns import qn
+from PIL import Image
+from contextvars import ContextVar
+import hashlib
 import json
+import threading
 
 
 load_dotenv()
 
 #===OpenAI===
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Retries are handled by the limiter so they count against the shared budget.
+client = RateLimitedOpenAI(
+    OpenAI(api_key=OPENAI_API_KEY, max_retries=0),
+    requests_per_minute=int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 500)),
+    tokens_per_minute=int(os.getenv("OPENAI_TOKENS_PER_MINUTE", 200000)),
+    max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", 8)),
+    max_retries=int(os.getenv("OPENAI_MAX_RETRIES", 6)),
+)
 #===Local Files Root directory===
 UPLOAD_FOLDER = os.getenv("UPLOAD_ROOT")
+# Internal state (caches, conversation history) is kept outside the upload
+# root, which is served to browsers.
+CACHE_FOLDER = os.getenv("CACHE_ROOT", "cache")
+#===File Serving Settings===
+# Small copies of images are served in chat answers instead of the originals.
+GENERATE_THUMBNAILS = os.getenv("GENERATE_THUMBNAILS", "true").lower() == "true"
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 512))
+THUMBNAIL_DIR = ".thumbs"
+#===Image Triage Settings===
+# Images extracted from PDFs are filtered before being sent for a description:
+# tiny images (bullets, spacers) are dropped, images repeated within a document
+# are kept once, and descriptions are cached by content hash across documents.
+MIN_IMAGE_SIDE = int(os.getenv("MIN_IMAGE_SIDE", 32))
+MIN_IMAGE_AREA = int(os.getenv("MIN_IMAGE_AREA", 64 * 64))
+# Within a document, re-encoded copies of an image are recognised by a
+# IMAGE_HASH_SIZE x IMAGE_HASH_SIZE difference hash differing in at most
+# IMAGE_HASH_DISTANCE bits. Hashes with fewer than a sixteenth of their bits
+# set (or unset) come from near-uniform images and never count as a match.
+IMAGE_HASH_SIZE = 16
+IMAGE_HASH_DISTANCE = int(os.getenv("IMAGE_HASH_DISTANCE", 4))
+CAPTION_CACHE_PATH = os.path.join(CACHE_FOLDER, "image_captions.json")
+# Formats that browsers and the vision model accept as-is; anything else is converted to PNG.
+WEB_IMAGE_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif", "WEBP": "webp"}
+#===Embedding Settings===
+# Topics remember the model and dimension they were embedded with, so these
+# only apply to new topics and to re-embedding migrations.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", 1536))
+# Topics created before the model was configurable were embedded with this.
+LEGACY_EMBEDDING_MODEL = "text-embedding-ada-002"
+LEGACY_EMBEDDING_DIMENSION = 1536
+FIXED_DIMENSION_MODELS = {"text-embedding-ada-002": 1536}
+# Models that can return shortened embeddings through the `dimensions` parameter.
+REDUCIBLE_DIMENSION_MODELS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072}
+#===Retrieval Settings===
+# Chosen with retrieval_sweep.py; both trade recall against vector count and prompt size.
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 250))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 5))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+QUERY_BATCH_CONCURRENCY = int(os.getenv("QUERY_BATCH_CONCURRENCY", 4))
 
 #===File-Processing Helper Methods===
 DOC_EXTENSIONS = ['.pdf', '.docx', '.pptx', '.txt']
 IMG_EXTENSIONS = ['.jpg', '.jpeg', '.png']
-def extract_text(file_path, chunk_size=500):
+def extract_text(file_path, chunk_size=500, overlap=CHUNK_OVERLAP):
+    return chunk_text(extract_full_text(file_path), chunk_size, overlap)
+
+def extract_full_text(file_path):
     ext = file_path.lower()
     full_text = ""
     if ext.endswith(".pdf"):
@@ -38,30 +94,55 @@ def extract_text(file_path, chunk_size=500):
             full_text = f.read()
     else:
         raise ValueError("Unsupported file format.")
-    return chunk_text(full_text, chunk_size)
+    return full_text
 
 def extract_images_from_pdf(document_dir, file_path, images_dir):
     reader = PdfReader(file_path)
     images = []
     alt_text_map = []
+    seen_digests = set()
+    seen_hashes = []
+    skipped = {"small": 0, "duplicate": 0, "unreadable": 0}
 
     for i, page in enumerate(reader.pages):
         for img_index, image in enumerate(page.images):
             img_data = image.data
-            img_filename = f"page-{i}-{img_index}.jpg"
-            img_path = os.path.join(images_dir, img_filename)
-
-            with open(img_path, "wb") as f:
-                f.write(img_data)
+            try:
+                with Image.open(io.BytesIO(img_data)) as pil_image:
+                    width, height = pil_image.size
+                    image_hash = image_dhash(pil_image, IMAGE_HASH_SIZE)
+            except Exception:
+                skipped["unreadable"] += 1
+                continue
+
+            # Bullets, spacers and the like are not worth a description.
+            if min(width, height) < MIN_IMAGE_SIDE or width * height < MIN_IMAGE_AREA:
+                skipped["small"] += 1
+                continue
+            # Logos and backgrounds repeated on every page are kept once.
+            digest = hashlib.sha256(img_data).hexdigest()
+            if digest in seen_digests or (hash_has_detail(image_hash) and any(
+                    hash_distance(image_hash, seen) <= IMAGE_HASH_DISTANCE for seen in seen_hashes)):
+                skipped["duplicate"] += 1
+                continue
+            seen_digests.add(digest)
+            if hash_has_detail(image_hash):
+                seen_hashes.append(image_hash)
+
+            img_path = save_image(images_dir, f"page-{i}-{img_index}", img_data)
+            generate_thumbnail(img_path)
 
             images.append(img_path)
 
-            alt_text = generate_gpt4_description(img_path)
+            alt_text = describe_image(img_path, digest)
             alt_text_map.append({
                 "path": img_path,
                 "alt_text": alt_text
             })
 
+    if any(skipped.values()):
+        print(f"Skipped images in {os.path.basename(file_path)}: {skipped}")
+
     # Save alt-image map for the PDF
     if alt_text_map:
         map_file_path = os.path.join(document_dir, "alt_image_map.json")
@@ -94,12 +175,8 @@ def extract_images_from_docx(document_dir, file_path, images_dir):
             image_part = doc.part.related_parts[rel_id]
             image_bytes = image_part.blob
 
-            ext = "jpg"
-            img_filename = f"{image_name}.{ext}"
-            img_path = os.path.join(images_dir, img_filename)
-
-            with open(img_path, "wb") as f:
-                f.write(image_bytes)
+            img_path = save_image(images_dir, image_name, image_bytes, fallback_ext=image_part.partname.ext)
+            generate_thumbnail(img_path)
 
             images.append(img_path)
             alt_text_map.append({
@@ -142,13 +219,8 @@ def extract_images_from_pptx(document_dir, file_path, images_dir):
                                 continue
 
                             image = shape.image
-                            ext = image.ext
-                            image_bytes = image.blob
-                            img_filename = f"{image_name}.{ext}"
-                            img_path = os.path.join(images_dir, img_filename)
-
-                            with open(img_path, "wb") as f:
-                                f.write(image_bytes)
+                            img_path = save_image(images_dir, image_name, image.blob, fallback_ext=image.ext)
+                            generate_thumbnail(img_path)
 
                             images.append(img_path)
                             alt_text_map.append({
@@ -165,11 +237,169 @@ def extract_images_from_pptx(document_dir, file_path, images_dir):
 
     return images
 
+def save_image(images_dir, base_name, image_bytes, fallback_ext="png"):
+    """
+    Writes extracted image bytes under the extension of their real format,
+    converting formats that browsers and the vision model cannot show to PNG.
+    Returns the saved path.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            ext = WEB_IMAGE_FORMATS.get(image.format)
+            if ext is None:
+                img_path = os.path.join(images_dir, f"{base_name}.png")
+                if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                image.save(img_path, format="PNG")
+                return img_path
+    except Exception:
+        ext = fallback_ext
+    img_path = os.path.join(images_dir, f"{base_name}.{ext}")
+    with open(img_path, "wb") as f:
+        f.write(image_bytes)
+    return img_path
+
+def image_dhash(image, hash_size=8):
+    """Difference hash of an image: a fingerprint that survives rescaling and re-compression."""
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            offset = row * (hash_size + 1) + col
+            bits = (bits << 1) | (pixels[offset] > pixels[offset + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+def hash_distance(hash_a, hash_b):
+    """Number of differing bits between two image hashes."""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+def hash_has_detail(image_hash):
+    """False for hashes of near-uniform images (blank, flat or smooth gradients), which all look alike."""
+    bits = len(image_hash) * 4
+    ones = bin(int(image_hash, 16)).count("1")
+    return min(ones, bits - ones) >= bits // 16
+
+class CaptionCache:
+    """Image descriptions persisted to a JSON file, keyed by the SHA-256 of the image's bytes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.captions = None
+
+    def _read(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def get(self, digest):
+        with self.lock:
+            if self.captions is None:
+                self.captions = self._read()
+            return self.captions.get(digest)
+
+    def put(self, digest, caption):
+        with self.lock:
+            # Other processes may have described other images meanwhile.
+            self.captions = {**self._read(), **(self.captions or {}), digest: caption}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.captions, f)
+            os.replace(temp_path, self.path)
+
+caption_cache = CaptionCache(CAPTION_CACHE_PATH)
+
+def describe_image(image_path, digest):
+    """Returns a description of the image, only asking GPT-4 if the same image bytes were never described before."""
+    caption = caption_cache.get(digest)
+    if caption is None:
+        caption = generate_gpt4_description(image_path)
+        caption_cache.put(digest, caption)
+    return caption
+
+def thumbnail_path(image_path):
+    return os.path.join(os.path.dirname(image_path), THUMBNAIL_DIR, os.path.basename(image_path))
+
+def generate_thumbnail(image_path):
+    """Saves a downscaled copy of an image next to it, returning its path (or None if disabled/unreadable)."""
+    if not GENERATE_THUMBNAILS:
+        return None
+    target = thumbnail_path(image_path)
+    try:
+        with Image.open(image_path) as image:
+            image_format = image.format
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            image.save(target, format=image_format)
+        return target
+    except Exception as e:
+        print(f"Could not create a thumbnail for {image_path}: {e}")
+        return None
+
+def file_version(file_path):
+    """A short token that changes whenever the file does, used to version URLs for caching."""
+    stat = os.stat(file_path)
+    return hashlib.sha1(f"{stat.st_size}-{stat.st_mtime_ns}".encode()).hexdigest()[:12]
+
 #===RAG Helper Methods===
-def get_embedding(text):
+def validate_embedding_settings(model, dimension):
+    """Raises ValueError if the model cannot produce embeddings of the given dimension."""
+    if model in FIXED_DIMENSION_MODELS:
+        if dimension != FIXED_DIMENSION_MODELS[model]:
+            raise ValueError(f"{model} only produces {FIXED_DIMENSION_MODELS[model]}-dimensional embeddings.")
+    elif model in REDUCIBLE_DIMENSION_MODELS:
+        if not 1 <= dimension <= REDUCIBLE_DIMENSION_MODELS[model]:
+            raise ValueError(f"{model} supports at most {REDUCIBLE_DIMENSION_MODELS[model]} dimensions.")
+    else:
+        raise ValueError(f"Unknown embedding model '{model}'.")
+
+class EmbeddingMemo:
+    """
+    Thread-safe store of embeddings already computed for a unit of work (e.g.
+    a batch of queries). While one is installed in `embedding_memo`, repeated
+    texts are only sent to OpenAI once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.embeddings = {}
+        self.hits = 0
+
+    def lookup(self, keys):
+        with self.lock:
+            found = {key: self.embeddings[key] for key in keys if key in self.embeddings}
+            self.hits += len(found)
+            return found
+
+    def store(self, entries):
+        with self.lock:
+            self.embeddings.update(entries)
+
+embedding_memo = ContextVar("embedding_memo", default=None)
+
+def get_embeddings(texts, model=None, dimension=None):
+    """Generates embeddings for a list of texts in a single request."""
+    model = model or EMBEDDING_MODEL
+    dimension = dimension or EMBEDDING_DIMENSION
+    memo = embedding_memo.get()
+    keys = [(model, dimension, text) for text in texts]
+    known = memo.lookup(keys) if memo is not None else {}
+    missing = list(dict.fromkeys(key for key in keys if key not in known))
+    if missing:
+        options = {"dimensions": dimension} if model in REDUCIBLE_DIMENSION_MODELS else {}
+        response = client.embeddings.create(input=[text for _, _, text in missing], model=model, **options)
+        fetched = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        known.update(zip(missing, fetched))
+        if memo is not None:
+            memo.store(dict(zip(missing, fetched)))
+    return [known[key] for key in keys]
+
+def get_embedding(text, model=None, dimension=None):
     """Generates an embedding for the given text."""
-    response = client.embeddings.create(input=text, model="text-embedding-ada-002")
-    return response.data[0].embedding
+    return get_embeddings([text], model, dimension)[0]
 
 def encode_image(image_path):
     with open(image_path, "rb") as image_file:
@@ -177,6 +407,8 @@ def encode_image(image_path):
 
 def generate_gpt4_description(image_path):
     image_data = encode_image(image_path)
+    ext = os.path.splitext(image_path)[1].lower().lstrip(".")
+    mime_type = "jpeg" if ext in ("jpg", "jpeg") else ext
     response = client.chat.completions.create(
         model="gpt-4-turbo",
         messages=[
@@ -185,14 +417,14 @@ def generate_gpt4_description(image_path):
                 "role": "user",
                 "content": [
                     {"type": "text", "text": "Describe this image in full detail."},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
+                    {"type": "image_url", "image_url": {"url": f"data:image/{mime_type};base64,{image_data}"}}
                 ],
             },
         ],
     )
     return response.choices[0].message.content
 
-def chunk_text(text, chunk_size=500, overlap=250):
+def chunk_text(text, chunk_size=500, overlap=CHUNK_OVERLAP):
     tokens = text.split()
     if chunk_size <= overlap:
         overlap = chunk_size // 2
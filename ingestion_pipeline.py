@@ -0,0 +1,186 @@
+"""
+Staged ingestion for /embed_files.
+
+Files flow through three stages connected by bounded queues:
+
+    parse   extract and chunk each document's text, read its image descriptions
+    embed   embed batches of chunks (reusing the blob's cached embeddings)
+    upsert  write batches of vectors to the topic's index
+
+Every stage runs on its own pool of worker threads, so parsing the next
+document, embedding the current one and upserting the previous one happen
+at the same time. A full queue blocks the stage feeding it, which keeps a
+fast parser from piling up work in memory while embedding catches up. With
+this overlap, total time approaches that of the slowest stage rather than
+the sum of all three.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from blob_store import EmbeddingCache, cached_text, resolve_document
+from helpers import DOC_EXTENSIONS, chunk_text, extract_full_text
+from pinecone_utils import vector_store_manager
+
+PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", 2))
+EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", 4))
+UPSERT_WORKERS = int(os.getenv("INGEST_UPSERT_WORKERS", 2))
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 8))
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", 64))
+UPSERT_BATCH_SIZE = 100
+
+_DONE = object()
+
+
+class Stage:
+    """A pool of worker threads applying `work(item, emit)` to items from an input queue."""
+
+    def __init__(self, name, work, workers, inbox, outbox, errors):
+        self.name = name
+        self.work = work
+        self.workers = max(1, workers)
+        self.inbox = inbox
+        self.outbox = outbox
+        # Shared by every stage: one {"file_name", "stage", "error"} entry per failed item.
+        self.errors = errors
+        self.lock = threading.Lock()
+        self.remaining = self.workers
+        self.counters = {"items_in": 0, "items_out": 0, "errors": 0, "busy_seconds": 0.0}
+        self.threads = [threading.Thread(target=self._run, name=f"ingest-{name}-{i}", daemon=True)
+                        for i in range(self.workers)]
+
+    def _count(self, **changes):
+        with self.lock:
+            for key, value in changes.items():
+                self.counters[key] += value
+
+    def _emit(self, item):
+        self._count(items_out=1)
+        if self.outbox is not None:
+            self.outbox.put(item)
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                break
+            self._count(items_in=1)
+            started = time.perf_counter()
+            try:
+                self.work(item, self._emit)
+            except Exception as e:
+                self._count(errors=1)
+                self.errors.append({"file_name": item.get("file_name"), "stage": self.name, "error": str(e)})
+            self._count(busy_seconds=time.perf_counter() - started)
+        # The last worker to finish tells every worker of the next stage to stop.
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last and self.outbox is not None:
+            for _ in range(self.downstream_workers):
+                self.outbox.put(_DONE)
+
+    def start(self, downstream_workers):
+        self.downstream_workers = downstream_workers
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self, elapsed):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["workers"] = self.workers
+        stats["busy_seconds"] = round(stats["busy_seconds"], 3)
+        stats["items_per_second"] = round(stats["items_out"] / elapsed, 2) if elapsed else 0.0
+        return stats
+
+
+def embed_files_pipelined(index_name, file_names, chunk_size=500, overlap=None,
+                          parse_workers=PARSE_WORKERS, embed_workers=EMBED_WORKERS, upsert_workers=UPSERT_WORKERS):
+    """
+    Embeds the given files of a topic through the staged pipeline. Returns
+    (text_vectors, image_vectors, errors, stats): the vectors actually
+    upserted, every item that failed, and per-stage counters.
+    """
+    vector_store_manager.ensure_not_migrating(index_name)
+    spec = vector_store_manager.get_topic_spec(index_name)
+    chunk_options = {} if overlap is None else {"overlap": overlap}
+    totals = {"text": 0, "image": 0}
+    totals_lock = threading.Lock()
+    # One embedding cache per blob for the whole run, so each blob's cache
+    # is read once however many batches it is embedded in.
+    caches = {}
+    caches_lock = threading.Lock()
+
+    def embedding_cache(blob_dir):
+        with caches_lock:
+            if blob_dir not in caches:
+                caches[blob_dir] = EmbeddingCache(blob_dir, spec["embedding_model"], spec["dimension"])
+            return caches[blob_dir]
+
+    def parse(job, emit):
+        file_name = job["file_name"]
+        document = resolve_document(index_name, file_name)
+        ext = "." + file_name.split(".")[-1].lower()
+        sources = []
+        if ext in DOC_EXTENSIONS:
+            chunks = chunk_text(cached_text(document, extract_full_text), chunk_size, **chunk_options)
+            sources.append(("text", chunks, [document["file_path"]] * len(chunks)))
+        if os.path.exists(document["alt_map_path"]):
+            with open(document["alt_map_path"], "r", encoding="utf-8") as f:
+                entries = [entry for entry in json.load(f)
+                           if entry.get("alt_text") and os.path.exists(entry.get("path", ""))]
+            sources.append(("image", [entry["alt_text"] for entry in entries], [entry["path"] for entry in entries]))
+
+        for embed_type, chunks, file_paths in sources:
+            for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+                emit({"file_name": file_name, "blob_dir": document["blob_dir"], "embed_type": embed_type,
+                      "offset": start, "chunks": chunks[start:start + EMBED_BATCH_SIZE],
+                      "file_paths": file_paths[start:start + EMBED_BATCH_SIZE]})
+
+    def embed(batch, emit):
+        embeddings = embedding_cache(batch["blob_dir"]).embed(batch["chunks"])
+        emit({"file_name": batch["file_name"], "embed_type": batch["embed_type"], "vectors": [
+            vector_store_manager.chunk_vector(batch["file_name"], batch["embed_type"], batch["offset"] + i,
+                                              chunk, batch["file_paths"][i], embeddings[i])
+            for i, chunk in enumerate(batch["chunks"])
+        ]})
+
+    def upsert(batch, emit):
+        # A re-embedding may have claimed the topic since the run started; its
+        # copy would miss these vectors, so every batch checks again.
+        vector_store_manager.ensure_not_migrating(index_name)
+        count = vector_store_manager.import_vectors(index_name, batch["vectors"], batch_size=UPSERT_BATCH_SIZE, spec=spec)
+        with totals_lock:
+            totals[batch["embed_type"]] += count
+        emit(batch)
+
+    parse_queue = queue.Queue()
+    embed_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    upsert_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    errors = []
+    stages = [
+        Stage("parse", parse, parse_workers, parse_queue, embed_queue, errors),
+        Stage("embed", embed, embed_workers, embed_queue, upsert_queue, errors),
+        Stage("upsert", upsert, upsert_workers, upsert_queue, None, errors),
+    ]
+
+    started = time.perf_counter()
+    for stage, downstream in zip(stages, stages[1:] + [None]):
+        stage.start(downstream.workers if downstream else 0)
+    for file_name in file_names:
+        parse_queue.put({"file_name": file_name})
+    for _ in range(stages[0].workers):
+        parse_queue.put(_DONE)
+    for stage in stages:
+        stage.join()
+    elapsed = time.perf_counter() - started
+
+    stats = {stage.name: stage.stats(elapsed) for stage in stages}
+    stats["elapsed_seconds"] = round(elapsed, 3)
+    return totals["text"], totals["image"], errors, stats
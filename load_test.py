@@ -0,0 +1,441 @@
+"""
+End-to-end load test for the Flask app.
+
+The app is started in this process against local stand-ins for its remote
+services, then driven by a number of simulated users at once:
+
+    OpenAI    a small HTTP server speaking the embeddings and chat completions
+              API (the app reaches it through OPENAI_BASE_URL). It answers the
+              planner with a fixed plan, so queries run the same plugin steps
+              as in production.
+    Pinecone  the in-memory store (PINECONE_BACKEND = "memory").
+
+Both stand-ins wait a log-normally distributed time before answering, given
+as "median,p95" in seconds, so that the app spends its time the way it would
+against the real services. Each simulated user keeps its own session cookie
+and repeatedly picks an operation from the traffic mix (queries, uploads,
+embeds and file listings) until the level's duration is up. For every
+concurrency level the test reports throughput, p50/p95/p99 latency and
+error rate per endpoint.
+
+Uploads, sessions and profiles go to a temporary directory that is removed
+afterwards. OpenAI calls still pass through the app's rate limiter, so its
+limits apply unless --unlimited-openai is given.
+
+Usage:
+    python load_test.py --concurrency 1,4,16,32 --duration 30 --mix query=6,list=2,upload=1,embed=1
+"""
+import argparse
+import base64
+import hashlib
+import http.cookiejar
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmark_utils import parse_ints, percentile
+
+LOAD_TEST_TOPIC = "load-test"
+REQUEST_TIMEOUT = 300
+MODEL_DIMENSIONS = {"text-embedding-ada-002": 1536, "text-embedding-3-small": 1536, "text-embedding-3-large": 3072}
+WORDS = ("river bridge harbor engine ledger contract invoice voltage turbine sensor policy budget "
+         "summit glacier archive protocol cluster latency schema quarterly revenue forecast audit "
+         "patient dosage trial compliance storage network region outage incident release roadmap").split()
+
+# The planner is always answered with this plan: select topics, retrieve, answer.
+PLAN_TEMPLATE = """<plan>
+    <function.QueryResponse{sep}determine_relevant_topics query="$query" topics="$topics" setContextVariable="FOUND_TOPICS"/>
+    <function.QueryResponse{sep}retrieve_context_chunks found_topics="$FOUND_TOPICS" query="$query" use_general_knowledge="$use_general_knowledge" setContextVariable="RETRIEVED_DATA"/>
+    <function.QueryResponse{sep}answer_query query="$query" retrieved_data="$RETRIEVED_DATA"/>
+</plan>"""
+
+
+class LatencyDistribution:
+    """Log-normal latency in seconds, described by its median and 95th percentile."""
+
+    def __init__(self, median, p95):
+        self.median = median
+        self.mu = math.log(median) if median > 0 else 0.0
+        self.sigma = math.log(p95 / median) / 1.645 if median > 0 and p95 > median else 0.0
+
+    def __call__(self):
+        return random.lognormvariate(self.mu, self.sigma) if self.median > 0 else 0.0
+
+    @classmethod
+    def parse(cls, text):
+        median, p95 = (float(part) for part in text.split(","))
+        return cls(median, p95)
+
+
+#===Fake OpenAI===
+def fake_vector(text, dimension):
+    """A deterministic pseudo-random unit vector for a text."""
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    values = [rng.gauss(0, 1) for _ in range(dimension)]
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+
+def fake_embeddings(body):
+    inputs = body.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    dimension = body.get("dimensions") or MODEL_DIMENSIONS.get(body.get("model"), 1536)
+    data = []
+    for i, text in enumerate(inputs):
+        embedding = fake_vector(str(text), dimension)
+        # The OpenAI SDK asks for base64-packed float32 unless told otherwise.
+        if body.get("encoding_format") == "base64":
+            embedding = base64.b64encode(array("f", embedding).tobytes()).decode("ascii")
+        data.append({"object": "embedding", "index": i, "embedding": embedding})
+    tokens = sum(len(str(text)) // 4 for text in inputs)
+    return {"object": "list", "data": data, "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+
+def fake_chat_completion(body, topic):
+    parts = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            parts += [part.get("text", "") for part in content if part.get("type") == "text"]
+        elif content:
+            parts.append(content)
+    prompt = "\n".join(parts)
+
+    if "<plan>" in prompt:
+        # Function names are listed to the planner as Plugin-function (or Plugin.function).
+        sep = "." if "QueryResponse.determine_relevant_topics" in prompt else "-"
+        content = PLAN_TEMPLATE.format(sep=sep)
+    elif "Given the following topics and their descriptions" in prompt:
+        content = json.dumps([topic])
+    else:
+        content = " ".join(random.choices(WORDS, k=120))
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                     "finish_reason": "stop", "logprobs": None}],
+        "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                  "total_tokens": (len(prompt) + len(content)) // 4},
+    }
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/embeddings"):
+            kind, latency = "embeddings", self.server.embedding_latency
+        elif self.path.endswith("/chat/completions"):
+            kind, latency = "chat", self.server.chat_latency
+        else:
+            self.send_error(404)
+            return
+        self.server.count(kind)
+        time.sleep(latency())
+        payload = fake_embeddings(body) if kind == "embeddings" else fake_chat_completion(body, self.server.topic)
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, embedding_latency, chat_latency, topic):
+        super().__init__(("127.0.0.1", 0), FakeOpenAIHandler)
+        self.embedding_latency = embedding_latency
+        self.chat_latency = chat_latency
+        self.topic = topic
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def take_calls(self):
+        with self.lock:
+            calls, self.calls = self.calls, {}
+        return calls
+
+
+#===Simulated Users===
+class Client:
+    """One simulated user with its own cookie jar, and therefore its own conversation."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def send(self, path, data, content_type):
+        request = urllib.request.Request(self.base_url + path, data=data, method="POST",
+                                         headers={"Content-Type": content_type})
+        try:
+            with self.opener.open(request, timeout=REQUEST_TIMEOUT) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def post_json(self, path, payload):
+        return self.send(path, json.dumps(payload).encode("utf-8"), "application/json")
+
+    def post_file(self, path, fields, file_name, content):
+        boundary = uuid.uuid4().hex
+        parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+                 for name, value in fields.items()]
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+                     f'Content-Type: text/plain\r\n\r\n'.encode("utf-8") + content + b"\r\n")
+        parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+        return self.send(path, b"".join(parts), f"multipart/form-data; boundary={boundary}")
+
+
+class TrafficState:
+    """Documents uploaded so far, shared by all simulated users."""
+
+    def __init__(self, topic, document_words):
+        self.topic = topic
+        self.document_words = document_words
+        self.lock = threading.Lock()
+        self.documents = []
+
+    def new_document(self, rng):
+        file_name = f"doc-{uuid.uuid4().hex[:12]}.txt"
+        return file_name, " ".join(rng.choices(WORDS, k=self.document_words)).encode("utf-8")
+
+    def add(self, file_name):
+        with self.lock:
+            self.documents.append(file_name)
+
+    def pick(self, rng):
+        with self.lock:
+            return rng.choice(self.documents) if self.documents else None
+
+
+def op_query(client, state, rng):
+    question = f"What does the {rng.choice(WORDS)} report say about the {rng.choice(WORDS)}?"
+    return client.post_json("/query", {"query": question, "topics": [state.topic], "use_general_knowledge": False})
+
+
+def op_list(client, state, rng):
+    return client.post_json("/list_uploaded_files", {"index_name": state.topic})
+
+
+def op_upload(client, state, rng):
+    file_name, content = state.new_document(rng)
+    status, body = client.post_file("/upload_document", {"index_name": state.topic}, file_name, content)
+    if status < 400:
+        state.add(file_name)
+    return status, body
+
+
+def op_embed(client, state, rng):
+    file_name = state.pick(rng)
+    if file_name is None:
+        return op_upload(client, state, rng)
+    return client.post_json("/embed_files", {"index_name": state.topic, "files": [file_name]})
+
+
+OPERATIONS = {"query": op_query, "list": op_list, "upload": op_upload, "embed": op_embed}
+
+
+#===Reporting===
+def summarize(records, elapsed):
+    """Per-operation (and overall) throughput, latency percentiles in ms and error rates."""
+    groups = {}
+    for operation, latency, error in records:
+        groups.setdefault(operation, []).append((latency, error))
+        groups.setdefault("all", []).append((latency, error))
+    summary = {}
+    for operation, entries in groups.items():
+        latencies = [latency * 1000 for latency, _ in entries]
+        errors = [error for _, error in entries if error]
+        summary[operation] = {
+            "requests": len(entries),
+            "throughput_rps": round(len(entries) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 0.50), 1),
+            "p95_ms": round(percentile(latencies, 0.95), 1),
+            "p99_ms": round(percentile(latencies, 0.99), 1),
+            "max_ms": round(max(latencies), 1),
+            "errors": len(errors),
+            "error_rate": round(len(errors) / len(entries), 4),
+        }
+        if errors:
+            summary[operation]["sample_error"] = errors[0]
+    return summary
+
+
+def print_level(level, out):
+    print(f"\nconcurrency={level['concurrency']}  duration={level['elapsed_seconds']}s  "
+          f"upstream OpenAI calls={level['openai_calls']}", file=out)
+    columns = ["requests", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "max_ms", "errors", "error_rate"]
+    print("\t".join(["endpoint"] + columns), file=out)
+    for operation, stats in sorted(level["endpoints"].items(), key=lambda item: item[0] == "all"):
+        print("\t".join([operation] + [str(stats[column]) for column in columns]), file=out)
+    for operation, stats in level["endpoints"].items():
+        if operation != "all" and "sample_error" in stats:
+            print(f"  {operation} error: {stats['sample_error']}", file=out)
+
+
+#===Running===
+def start_app(workdir, openai_url, pinecone_latency, unlimited_openai):
+    """Boots the app on a local port against the stand-ins and returns (server, base_url)."""
+    os.chdir(workdir)
+    os.environ.update({
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "load-test"),
+        "OPENAI_BASE_URL": openai_url,
+        "PINECONE_BACKEND": "memory",
+        "UPLOAD_ROOT": "uploads",
+        "SESSION_DB_PATH": os.path.join(workdir, "sessions.sqlite3"),
+        "PROFILE_DIR": os.path.join(workdir, "profiles"),
+    })
+    if unlimited_openai:
+        os.environ.update({"OPENAI_REQUESTS_PER_MINUTE": "1000000", "OPENAI_TOKENS_PER_MINUTE": "1000000000",
+                           "OPENAI_MAX_CONCURRENCY": "1000"})
+
+    # Imported only now, so the settings above are what the app reads.
+    from werkzeug.serving import make_server
+    from pinecone_utils import vector_store_manager
+    import app as flask_app
+
+    vector_store_manager.pc.set_latency(pinecone_latency)
+    server = make_server("127.0.0.1", 0, flask_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="load-test-app", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def seed_topic(base_url, state, documents):
+    client = Client(base_url)
+    status, body = client.post_json("/create_index", {"index_name": state.topic, "description": "Load test documents."})
+    if status >= 400:
+        raise SystemExit(f"Could not create the load test topic: {body.decode('utf-8', 'replace')}")
+    rng = random.Random(0)
+    for _ in range(documents):
+        op_upload(client, state, rng)
+    with state.lock:
+        seeded = list(state.documents)
+    if seeded:
+        client.post_json("/embed_files", {"index_name": state.topic, "files": seeded})
+
+
+def run_level(base_url, state, concurrency, duration, mix, think_time):
+    operations, weights = zip(*mix.items())
+    records = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def user():
+        client = Client(base_url)
+        rng = random.Random()
+        while time.perf_counter() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            started = time.perf_counter()
+            try:
+                status, body = OPERATIONS[operation](client, state, rng)
+                error = None if status < 400 else f"HTTP {status}: {body[:200].decode('utf-8', 'replace')}"
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            with lock:
+                records.append((operation, time.perf_counter() - started, error))
+            if think_time:
+                time.sleep(rng.expovariate(1 / think_time))
+
+    started = time.perf_counter()
+    users = [threading.Thread(target=user, name=f"load-test-user-{i}") for i in range(concurrency)]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {"concurrency": concurrency, "elapsed_seconds": round(elapsed, 1), "endpoints": summarize(records, elapsed)}
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        operation, _, weight = part.partition("=")
+        if operation.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation '{operation}'; choose from {list(OPERATIONS)}.")
+        mix[operation.strip()] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app against local OpenAI and Pinecone stand-ins.")
+    parser.add_argument("--concurrency", type=parse_ints, default=[1, 4, 16], help="Simulated users per level.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds per concurrency level.")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("query=6,list=2,upload=1,embed=1"))
+    parser.add_argument("--think-time", type=float, default=0, help="Mean pause between a user's requests, in seconds.")
+    parser.add_argument("--seed-documents", type=int, default=5)
+    parser.add_argument("--document-words", type=int, default=1500)
+    parser.add_argument("--embedding-latency", type=LatencyDistribution.parse, default="0.15,0.4", help="median,p95 seconds")
+    parser.add_argument("--chat-latency", type=LatencyDistribution.parse, default="1.5,4.0", help="median,p95 seconds")
+    parser.add_argument("--pinecone-latency", type=LatencyDistribution.parse, default="0.03,0.1", help="median,p95 seconds")
+    parser.add_argument("--unlimited-openai", action="store_true", help="Lift the app's OpenAI rate limits.")
+    parser.add_argument("--app-output", action="store_true", help="Show the app's own log output.")
+    parser.add_argument("--output", help="Write the results to a JSON file.")
+    args = parser.parse_args()
+
+    out = sys.stdout
+    output_path = os.path.abspath(args.output) if args.output else None
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo_dir)
+    workdir = tempfile.mkdtemp(prefix="rag-load-test-")
+    openai_server = FakeOpenAIServer(args.embedding_latency, args.chat_latency, LOAD_TEST_TOPIC)
+    threading.Thread(target=openai_server.serve_forever, name="fake-openai", daemon=True).start()
+    app_server = None
+    levels = []
+    try:
+        if not args.app_output:
+            sys.stdout = open(os.devnull, "w")
+        app_server, base_url = start_app(workdir, f"http://127.0.0.1:{openai_server.server_port}/v1",
+                                         args.pinecone_latency, args.unlimited_openai)
+        state = TrafficState(LOAD_TEST_TOPIC, args.document_words)
+        print(f"Seeding '{LOAD_TEST_TOPIC}' with {args.seed_documents} documents...", file=out)
+        seed_topic(base_url, state, args.seed_documents)
+        openai_server.take_calls()
+
+        for concurrency in args.concurrency:
+            print(f"Running {concurrency} users for {args.duration:g}s...", file=out)
+            level = run_level(base_url, state, concurrency, args.duration, args.mix, args.think_time)
+            level["openai_calls"] = openai_server.take_calls()
+            levels.append(level)
+            print_level(level, out)
+    finally:
+        if sys.stdout is not out:
+            sys.stdout.close()
+            sys.stdout = out
+        if app_server is not None:
+            app_server.shutdown()
+        openai_server.shutdown()
+        os.chdir(repo_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(levels, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+A small in-memory stand-in for the parts of the Pinecone client this app
+uses. It is meant for offline work such as retrieval experiments and load
+tests, where paying for (or waiting on) a real index is not wanted.
+
+MemoryPinecone mirrors the client (list_indexes, create_index, describe_index,
+delete_index, Index) and MemoryIndex mirrors an index (upsert, query, fetch,
+delete, update, list), including simple metadata filters ($eq, $ne, $in, $nin).
+Setting PINECONE_BACKEND = "memory" makes the app itself use it. A latency
+sampler (a function returning seconds) can be installed with
+MemoryPinecone.set_latency() so that calls take about as long as real ones.
+"""
+import math
+import threading
+import time
+from types import SimpleNamespace
+
+
+def _normalize(values):
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+
+def _matches_filter(metadata, metadata_filter):
+    for field, condition in (metadata_filter or {}).items():
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        value = metadata.get(field)
+        for operator, expected in condition.items():
+            if operator == "$eq" and value != expected:
+                return False
+            if operator == "$ne" and value == expected:
+                return False
+            if operator == "$in" and value not in expected:
+                return False
+            if operator == "$nin" and value in expected:
+                return False
+    return True
+
+
+class MemoryIndex:
+    def __init__(self, dimension, latency=None):
+        self.dimension = dimension
+        self.namespaces = {}
+        self.lock = threading.Lock()
+        self.latency = latency
+
+    def _namespace(self, namespace):
+        return self.namespaces.setdefault(namespace or "", {})
+
+    def _wait(self):
+        # Simulated network time is spent outside the lock, like a real round trip.
+        if self.latency is not None:
+            time.sleep(max(0.0, self.latency()))
+
+    def upsert(self, vectors, namespace=""):
+        self._wait()
+        with self.lock:
+            records = self._namespace(namespace)
+            for vector in vectors:
+                if len(vector["values"]) != self.dimension:
+                    raise ValueError(f"Vector dimension {len(vector['values'])} does not match the index dimension {self.dimension}.")
+                records[vector["id"]] = {
+                    "values": list(vector["values"]),
+                    "unit": _normalize(vector["values"]),
+                    "metadata": dict(vector.get("metadata", {})),
+                }
+
+    def query(self, vector, top_k=10, namespace="", filter=None, include_metadata=False, include_values=False):
+        self._wait()
+        query_unit = _normalize(vector)
+        with self.lock:
+            candidates = [(vector_id, record) for vector_id, record in self._namespace(namespace).items()
+                          if _matches_filter(record["metadata"], filter)]
+        scored = sorted(
+            ((sum(a * b for a, b in zip(query_unit, record["unit"])), vector_id, record) for vector_id, record in candidates),
+            key=lambda match: -match[0]
+        )[:top_k]
+        matches = []
+        for score, vector_id, record in scored:
+            match = {"id": vector_id, "score": score}
+            if include_metadata:
+                match["metadata"] = dict(record["metadata"])
+            if include_values:
+                match["values"] = list(record["values"])
+            matches.append(match)
+        return {"matches": matches}
+
+    def fetch(self, ids, namespace=""):
+        self._wait()
+        with self.lock:
+            records = self._namespace(namespace)
+            vectors = {vector_id: {"id": vector_id, "values": list(records[vector_id]["values"]),
+                                   "metadata": dict(records[vector_id]["metadata"])}
+                       for vector_id in ids if vector_id in records}
+        return SimpleNamespace(vectors=vectors)
+
+    def delete(self, ids, namespace=""):
+        self._wait()
+        with self.lock:
+            records = self._namespace(namespace)
+            for vector_id in ids:
+                records.pop(vector_id, None)
+
+    def update(self, id, set_metadata=None, namespace=""):
+        self._wait()
+        with self.lock:
+            record = self._namespace(namespace).get(id)
+            if record is not None:
+                record["metadata"].update(set_metadata or {})
+
+    def list(self, prefix="", namespace="", limit=100):
+        self._wait()
+        with self.lock:
+            ids = sorted(vector_id for vector_id in self._namespace(namespace) if vector_id.startswith(prefix or ""))
+        for start in range(0, len(ids), limit):
+            yield ids[start:start + limit]
+
+    def describe_index_stats(self):
+        with self.lock:
+            return {"dimension": self.dimension,
+                    "namespaces": {name: {"vector_count": len(records)} for name, records in self.namespaces.items()},
+                    "total_vector_count": sum(len(records) for records in self.namespaces.values())}
+
+
+class _IndexList(list):
+    def names(self):
+        return list(self)
+
+
+class MemoryPinecone:
+    def __init__(self, api_key=None, **kwargs):
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.latency = None
+
+    def set_latency(self, latency):
+        """Applies a latency sampler to every existing and future index."""
+        with self.lock:
+            self.latency = latency
+            for index in self.indexes.values():
+                index.latency = latency
+
+    def list_indexes(self):
+        with self.lock:
+            return _IndexList(self.indexes)
+
+    def create_index(self, name, dimension, metric="cosine", spec=None, **kwargs):
+        with self.lock:
+            if name in self.indexes:
+                raise ValueError(f"Index '{name}' already exists.")
+            self.indexes[name] = MemoryIndex(dimension, self.latency)
+
+    def describe_index(self, name):
+        return SimpleNamespace(name=name, dimension=self.indexes[name].dimension, metric="cosine")
+
+    def delete_index(self, name):
+        with self.lock:
+            self.indexes.pop(name)
+
+    def Index(self, name):
+        return self.indexes[name]
@@ -0,0 +1,84 @@
+"""
+Moves topics stored as separate Pinecone indexes into the shared index used
+when PINECONE_STORAGE_MODE is "shared". Refuses to run in any other mode.
+
+Vectors are copied as-is (no re-embedding): each vector id is prefixed with
+"<topic>#" and a "topic" field is added to its metadata. The original indexes
+are only deleted when --delete-old is given, after their vectors have been
+copied.
+
+Usage:
+    python migrate_storage.py                 # migrate every per-topic index
+    python migrate_storage.py topic-a topic-b --delete-old
+"""
+import argparse
+
+import pinecone_utils
+from helpers import EMBEDDING_MODEL, EMBEDDING_DIMENSION
+from pinecone_utils import vector_store_manager, SHARED_INDEX
+
+UPSERT_BATCH_SIZE = 100
+
+
+def migrate_topic(topic, delete_old=False):
+    if pinecone_utils.STORAGE_MODE != "shared":
+        raise ValueError('Set PINECONE_STORAGE_MODE = "shared" before moving topics into the shared index.')
+    manager = vector_store_manager
+    spec = manager.get_topic_spec(topic)
+    if manager.in_shared_index(spec):
+        raise ValueError(f"'{topic}' is already stored in the shared index.")
+    if (spec["embedding_model"], spec["dimension"]) != (EMBEDDING_MODEL, EMBEDDING_DIMENSION):
+        raise ValueError(f"'{topic}' is embedded with {spec['embedding_model']} ({spec['dimension']} dimensions); "
+                         f"re-embed it with the configured model before moving it into the shared index.")
+    source = manager.pc.Index(spec["index"])
+    target = manager.pc.Index(SHARED_INDEX)
+
+    ids = manager.list_vector_ids(source)
+    batch = []
+    copied = 0
+    for vector_id, values, metadata in manager.fetch_vectors(source, ids):
+        metadata["topic"] = topic
+        batch.append({"id": f"{topic}#{vector_id}", "values": values, "metadata": metadata})
+        if len(batch) >= UPSERT_BATCH_SIZE:
+            target.upsert(vectors=batch, namespace="docs")
+            copied += len(batch)
+            batch = []
+    if batch:
+        target.upsert(vectors=batch, namespace="docs")
+        copied += len(batch)
+
+    manager.create_topic_directory(topic)
+    if copied != len(ids):
+        raise RuntimeError(f"Only {copied} of {len(ids)} vectors were copied for '{topic}'; keeping the old index.")
+    manager.switch_topic_spec(topic, {**spec, "index": SHARED_INDEX})
+    if delete_old:
+        manager.pc.delete_index(spec["index"])
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate per-topic Pinecone indexes into the shared index.")
+    parser.add_argument("topics", nargs="*", help="Topics to migrate (defaults to every per-topic index).")
+    parser.add_argument("--delete-old", action="store_true", help="Delete each per-topic index once it is migrated.")
+    args = parser.parse_args()
+    if pinecone_utils.STORAGE_MODE != "shared":
+        parser.exit(1, 'Set PINECONE_STORAGE_MODE = "shared" in your .env before migrating; '
+                       'topics moved while it is "index" would keep being created outside the shared index.\n')
+
+    manager = vector_store_manager
+    manager.ensure_shared_index()
+    physical_indexes = manager.pc.list_indexes().names()
+    existing = [topic for topic, spec in manager.get_topic_specs(manager.list_indexes()).items()
+                if spec["index"] != SHARED_INDEX and spec["index"] in physical_indexes]
+    topics = args.topics or existing
+
+    for topic in topics:
+        if topic not in existing:
+            print(f"Skipping '{topic}': it has no index of its own.")
+            continue
+        copied = migrate_topic(topic, delete_old=args.delete_old)
+        print(f"Migrated '{topic}': {copied} vectors{' (old index deleted)' if args.delete_old else ''}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Re-embedding claims and progress, kept in SQLite so that every worker
+process (and every host sharing the database file) sees the same state.
+
+A topic is claimed for re-embedding in a single write transaction, so two
+concurrent requests can never both start a migration of the same topic.
+While a claim is held, the topic refuses writes and deletes in every
+process. The migrating process refreshes its claim whenever it reports
+progress; a claim not refreshed for MIGRATION_STALE_SECONDS is assumed to
+belong to a process that died and may be taken over.
+"""
+import json
+import os
+import time
+
+import sqlite_store
+from helpers import CACHE_FOLDER
+
+MIGRATION_DB_PATH = os.getenv("MIGRATION_DB_PATH", os.path.join(CACHE_FOLDER, "migrations.sqlite3"))
+MIGRATION_STALE_SECONDS = int(os.getenv("MIGRATION_STALE_SECONDS", 600))
+
+
+class MigrationInProgress(RuntimeError):
+    """Raised when a topic cannot be changed because it is being re-embedded."""
+
+
+MIGRATIONS_SCHEMA = ["""
+    CREATE TABLE IF NOT EXISTS migrations (
+        topic TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        status TEXT NOT NULL,
+        heartbeat REAL NOT NULL
+    )
+"""]
+
+
+def _connect():
+    return sqlite_store.connect(MIGRATION_DB_PATH, MIGRATIONS_SCHEMA)
+
+
+def _is_active(state, heartbeat):
+    return state == "running" and heartbeat > time.time() - MIGRATION_STALE_SECONDS
+
+
+def claim(topic, **status):
+    """Marks the topic as being re-embedded. Returns False if another migration of it is still running."""
+    connection = _connect()
+    connection.isolation_level = None
+    try:
+        # BEGIN IMMEDIATE takes the write lock before reading, so the check
+        # and the claim cannot interleave with another process's.
+        connection.execute("BEGIN IMMEDIATE")
+        row = connection.execute("SELECT state, heartbeat FROM migrations WHERE topic = ?", (topic,)).fetchone()
+        if row and _is_active(*row):
+            connection.execute("ROLLBACK")
+            return False
+        connection.execute("INSERT OR REPLACE INTO migrations (topic, state, status, heartbeat) VALUES (?, ?, ?, ?)",
+                           (topic, "running", json.dumps({**status, "state": "running"}), time.time()))
+        connection.execute("COMMIT")
+        return True
+    except Exception:
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+
+def update(topic, state=None, **fields):
+    """Merges fields into the topic's status and refreshes its claim. A new state ends or renews the claim."""
+    connection = _connect()
+    try:
+        with connection:
+            row = connection.execute("SELECT state, status FROM migrations WHERE topic = ?", (topic,)).fetchone()
+            if row is None:
+                return
+            state = state or row[0]
+            status = {**json.loads(row[1]), **fields, "state": state}
+            connection.execute("UPDATE migrations SET state = ?, status = ?, heartbeat = ? WHERE topic = ?",
+                               (state, json.dumps(status), time.time(), topic))
+    finally:
+        connection.close()
+
+
+def is_migrating(topic):
+    connection = _connect()
+    try:
+        row = connection.execute("SELECT state, heartbeat FROM migrations WHERE topic = ?", (topic,)).fetchone()
+    finally:
+        connection.close()
+    return bool(row) and _is_active(*row)
+
+
+def get_status(topic):
+    """Returns the topic's last reported migration status, or {} if it was never re-embedded."""
+    connection = _connect()
+    try:
+        row = connection.execute("SELECT state, status, heartbeat FROM migrations WHERE topic = ?", (topic,)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return {}
+    state, status, heartbeat = row
+    status = json.loads(status)
+    if state == "running" and not _is_active(state, heartbeat):
+        status["state"] = "stale"
+    return status
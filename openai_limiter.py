@@ -0,0 +1,178 @@
+"""
+Rate-limit-aware wrapper around the OpenAI client.
+
+Every call made through the wrapper is throttled by two token buckets (one
+for requests per minute and one for tokens per minute), capped by a
+concurrency limit that is shared by all threads, and retried with jittered
+exponential backoff when OpenAI reports a rate limit or a transient error.
+Only the endpoints this app uses are exposed: client.embeddings.create and
+client.chat.completions.create.
+"""
+import random
+import threading
+import time
+
+import openai
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+# Rough token costs used to reserve rate-limit capacity before a call.
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1000
+DEFAULT_COMPLETION_TOKENS = 1000
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `per_minute` units per minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount):
+        """Blocks until `amount` units are available and takes them. Returns seconds waited."""
+        # A single request larger than the bucket would otherwise wait forever.
+        amount = min(float(amount), self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return waited
+                delay = (amount - self.available) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def estimate_tokens(kwargs):
+    """Estimates the tokens a request will use, counting prompt text, images and the completion."""
+    text_chars = 0
+    images = 0
+    payload = kwargs.get("input")
+    if payload is not None:
+        for item in payload if isinstance(payload, list) else [payload]:
+            text_chars += len(str(item))
+        return text_chars // CHARS_PER_TOKEN + 1
+
+    for message in kwargs.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                text_chars += len(part.get("text", ""))
+            else:
+                images += 1
+    completion = kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    return text_chars // CHARS_PER_TOKEN + images * IMAGE_TOKENS + completion
+
+
+class _Endpoint:
+    def __init__(self, limiter, create):
+        self.limiter = limiter
+        self._create = create
+
+    def create(self, **kwargs):
+        return self.limiter.call(self._create, **kwargs)
+
+
+class _Namespace:
+    pass
+
+
+class RateLimitedOpenAI:
+    def __init__(self, client, requests_per_minute, tokens_per_minute, max_concurrency,
+                 max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.client = client
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.concurrency = threading.BoundedSemaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.embeddings = _Endpoint(self, client.embeddings.create)
+        self.chat = _Namespace()
+        self.chat.completions = _Endpoint(self, client.chat.completions.create)
+
+        self._metrics_lock = threading.Lock()
+        self._metrics = {
+            "requests": 0,
+            "failures": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "estimated_tokens": 0,
+            "used_tokens": 0,
+            "throttle_wait_seconds": 0.0,
+            "backoff_wait_seconds": 0.0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+        }
+
+    def _record(self, **changes):
+        with self._metrics_lock:
+            for key, value in changes.items():
+                self._metrics[key] += value
+            self._metrics["max_in_flight"] = max(self._metrics["max_in_flight"], self._metrics["in_flight"])
+
+    def metrics(self):
+        with self._metrics_lock:
+            return dict(self._metrics)
+
+    def _backoff(self, attempt, error):
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                retry_after = None
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        # Full jitter keeps threads that were throttled together from retrying together.
+        delay = random.uniform(0, delay)
+        return max(delay, retry_after or 0.0)
+
+    def call(self, create, **kwargs):
+        estimated = estimate_tokens(kwargs)
+        attempt = 0
+        while True:
+            waited = self.request_bucket.acquire(1) + self.token_bucket.acquire(estimated)
+            self._record(requests=1, estimated_tokens=estimated, throttle_wait_seconds=waited)
+            with self.concurrency:
+                self._record(in_flight=1)
+                try:
+                    response = create(**kwargs)
+                except RETRYABLE_ERRORS as e:
+                    error = e
+                except Exception:
+                    self._record(failures=1)
+                    raise
+                else:
+                    usage = getattr(response, "usage", None)
+                    self._record(used_tokens=getattr(usage, "total_tokens", 0) or 0)
+                    return response
+                finally:
+                    self._record(in_flight=-1)
+
+            if attempt >= self.max_retries:
+                self._record(failures=1)
+                raise error
+            delay = self._backoff(attempt, error)
+            self._record(retries=1, backoff_wait_seconds=delay,
+                         rate_limited=int(isinstance(error, openai.RateLimitError)))
+            time.sleep(delay)
+            attempt += 1
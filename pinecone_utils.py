@@ -1,6 +1,16 @@
 from pinecone.grpc import PineconeGRPC as Pinecone
 from pinecone import ServerlessSpec
-from helpers import UPLOAD_FOLDER, get_embedding
+from helpers import (UPLOAD_FOLDER,
+                     EMBEDDING_MODEL,
+                     EMBEDDING_DIMENSION,
+                     LEGACY_EMBEDDING_MODEL,
+                     LEGACY_EMBEDDING_DIMENSION,
+                     RETRIEVAL_TOP_K,
+                     get_embedding,
+                     validate_embedding_settings)
+from blob_store import cached_embeddings, collect_garbage
+from memory_store import MemoryPinecone
+import migration_store
 import os
 import shutil
 from dotenv import load_dotenv
@@ -9,40 +19,80 @@ load_dotenv()
 
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 TABLE_OF_CONTENTS_INDEX = "table-of-contents"
+# "index" keeps one Pinecone index per topic; "shared" keeps every topic in a
+# single index, partitioned by a "topic" metadata field.
+STORAGE_MODE = os.getenv("PINECONE_STORAGE_MODE", "index")
+SHARED_INDEX = os.getenv("PINECONE_SHARED_INDEX", "rag-topics")
+# "memory" keeps every index inside this process (see memory_store.py), for
+# load tests and offline experiments. Nothing is persisted.
+PINECONE_BACKEND = os.getenv("PINECONE_BACKEND", "pinecone")
+FETCH_BATCH_SIZE = 100
 
 class PineconeManager:
     def __init__(self):
-        self.pc = Pinecone(api_key=PINECONE_API_KEY)
+        validate_embedding_settings(EMBEDDING_MODEL, EMBEDDING_DIMENSION)
+        self.pc = MemoryPinecone() if PINECONE_BACKEND == "memory" else Pinecone(api_key=PINECONE_API_KEY)
         self.ensure_upload_folder()
         self.ensure_table_of_contents_index()
+        self.toc_dimension = self.pc.describe_index(TABLE_OF_CONTENTS_INDEX).dimension
+        if STORAGE_MODE == "shared":
+            self.ensure_shared_index()
 
     def ensure_upload_folder(self):
         if not os.path.exists(UPLOAD_FOLDER):
             os.makedirs(UPLOAD_FOLDER)
 
+    def create_physical_index(self, name, dimension=EMBEDDING_DIMENSION):
+        self.pc.create_index(
+            name=name,
+            dimension=dimension,
+            metric="cosine",
+            spec=ServerlessSpec(cloud='aws', region='us-east-1')
+        )
+
     def ensure_table_of_contents_index(self):
         if TABLE_OF_CONTENTS_INDEX not in self.pc.list_indexes().names():
-            self.pc.create_index(
-                name=TABLE_OF_CONTENTS_INDEX,
-                dimension=1536,
-                metric="cosine",
-                spec=ServerlessSpec(cloud='aws', region='us-east-1')
-            )
+            self.create_physical_index(TABLE_OF_CONTENTS_INDEX)
+
+    def ensure_shared_index(self):
+        if SHARED_INDEX not in self.pc.list_indexes().names():
+            self.create_physical_index(SHARED_INDEX)
 
     def list_indexes(self):
-        return [idx for idx in self.pc.list_indexes().names() if idx != TABLE_OF_CONTENTS_INDEX]
+        """Lists topic names. Every topic is registered in the table of contents."""
+        toc_index = self.pc.Index(TABLE_OF_CONTENTS_INDEX)
+        return sorted(vector_id for ids in toc_index.list() for vector_id in ids)
 
-    def create_index(self, index_name):
-        self.pc.create_index(
-            name=index_name,
-            dimension=1536,
-            metric="cosine",
-            spec=ServerlessSpec(cloud='aws', region='us-east-1')
-        )
+    def create_index(self, index_name, description="", embedding_model=None, dimension=None, embedding=None):
+        """
+        Creates a topic: its Pinecone index (unless topics share one), its upload
+        directory, and its table-of-contents entry recording how it is embedded.
+        """
+        embedding_model = embedding_model or EMBEDDING_MODEL
+        dimension = dimension or EMBEDDING_DIMENSION
+        validate_embedding_settings(embedding_model, dimension)
+        if index_name in (TABLE_OF_CONTENTS_INDEX, SHARED_INDEX):
+            raise ValueError(f"'{index_name}' is reserved and cannot be used as a topic name.")
+        if STORAGE_MODE == "shared":
+            if (embedding_model, dimension) != (EMBEDDING_MODEL, EMBEDDING_DIMENSION):
+                raise ValueError("Topics in the shared index must use the configured embedding model and dimension.")
+        else:
+            self.create_physical_index(index_name, dimension)
         self.create_topic_directory(index_name)
+        self.upsert_metadata(index_name, description, embedding, spec={
+            "index": SHARED_INDEX if STORAGE_MODE == "shared" else index_name,
+            "embedding_model": embedding_model,
+            "dimension": dimension,
+        })
 
     def delete_index(self, index_name):
-        self.pc.delete_index(index_name)
+        """Deletes a topic. A topic in the shared index only loses its own vectors, never the index."""
+        self.ensure_not_migrating(index_name)
+        spec = self.get_topic_spec(index_name)
+        if self.in_shared_index(spec):
+            self.delete_vectors_by_prefix(self.pc.Index(SHARED_INDEX), self.vector_id_prefix(index_name, spec))
+        else:
+            self.pc.delete_index(spec["index"])
         self.delete_topic_directory(index_name)
         toc_index = self.pc.Index(TABLE_OF_CONTENTS_INDEX)
         toc_index.delete(ids=[index_name])
@@ -55,17 +105,55 @@ class PineconeManager:
         topic_dir = os.path.join(UPLOAD_FOLDER, index_name)
         if os.path.exists(topic_dir):
             shutil.rmtree(topic_dir)
+        collect_garbage()
 
-    def upsert_metadata(self, index_name, description):
+    def upsert_metadata(self, index_name, description, embedding=None, spec=None):
+        """Saves a topic's description, keeping its embedding spec unless a new one is given."""
         index = self.pc.Index(TABLE_OF_CONTENTS_INDEX)
-        embedding = get_embedding(description)
+        if spec is None:
+            spec = self.get_topic_spec(index_name)
+        if embedding is None:
+            # Description vectors are only ever fetched by id, never searched, so
+            # they need to match the table of contents rather than the topic.
+            embedding = get_embedding(description, dimension=self.toc_dimension)
         vector = {
             "id": index_name,
             "values": embedding,
-            "metadata": {"description": description}
+            "metadata": {"description": description, **spec}
         }
         index.upsert(vectors=[vector])
 
+    def get_registry(self):
+        """Returns {topic: table-of-contents metadata} for every topic, in one listing and fetch."""
+        toc_index = self.pc.Index(TABLE_OF_CONTENTS_INDEX)
+        return {vector_id: metadata for vector_id, _, metadata in self.fetch_vectors(toc_index, self.list_indexes(), namespace="")}
+
+    def get_topic_specs(self, index_names, registry=None):
+        """
+        Returns {topic: {"index", "embedding_model", "dimension"}} describing where
+        each topic's vectors live and how its queries must be embedded.
+        """
+        if registry is None:
+            toc_index = self.pc.Index(TABLE_OF_CONTENTS_INDEX)
+            registry = {vector_id: metadata for vector_id, _, metadata in self.fetch_vectors(toc_index, list(index_names), namespace="")}
+        specs = {}
+        for index_name in index_names:
+            metadata = registry.get(index_name, {})
+            specs[index_name] = {
+                "index": metadata.get("index", index_name),
+                "embedding_model": metadata.get("embedding_model", LEGACY_EMBEDDING_MODEL),
+                "dimension": int(metadata.get("dimension", LEGACY_EMBEDDING_DIMENSION)),
+            }
+        return specs
+
+    def get_topic_spec(self, index_name):
+        return self.get_topic_specs([index_name])[index_name]
+
+    def switch_topic_spec(self, index_name, spec):
+        """Points a topic at a new index and embedding spec in a single metadata update."""
+        toc_index = self.pc.Index(TABLE_OF_CONTENTS_INDEX)
+        toc_index.update(id=index_name, set_metadata=spec)
+
     def get_index_description(self, index_name):
         toc_index = self.pc.Index(TABLE_OF_CONTENTS_INDEX)
         response = toc_index.fetch(ids=[index_name])
@@ -74,42 +162,83 @@ class PineconeManager:
             return metadata.get("description", "No description available.")
         return "No description available."
 
-    def get_descriptions(self):
-        """Retrieve descriptions for all indexes except the table of contents."""
+    def get_index_entry(self, index_name):
+        """Returns the table-of-contents (embedding, metadata) for a topic, or (None, {}) if it has none."""
         toc_index = self.pc.Index(TABLE_OF_CONTENTS_INDEX)
-        all_indexes = self.list_indexes()
-        descriptions = {}
-        response = toc_index.fetch(ids=all_indexes)
-        if hasattr(response, "vectors"):
-            for idx in all_indexes:
-                metadata = response.vectors.get(idx, {}).get("metadata", {})
-                descriptions[idx] = metadata.get("description", "No description available.")
-        return descriptions
-
-    def delete_vectors_by_source(self, index_name, file_name):
-        index = self.pc.Index(index_name)
+        for _, values, metadata in self.fetch_vectors(toc_index, [index_name], namespace=""):
+            return values, metadata
+        return None, {}
+
+    def get_descriptions(self, registry=None):
+        """Retrieve descriptions for all indexes except the table of contents."""
+        if registry is None:
+            registry = self.get_registry()
+        return {idx: metadata.get("description", "No description available.") for idx, metadata in registry.items()}
+
+    def in_shared_index(self, spec):
+        """
+        Whether a topic's vectors live in the shared index. Decided by the
+        topic's own spec rather than PINECONE_STORAGE_MODE, since migrated and
+        per-topic indexes can coexist while the mode is being switched.
+        """
+        return spec["index"] == SHARED_INDEX
+
+    def topic_index(self, index_name, spec=None):
+        """Returns the Pinecone index holding the vectors for the given topic."""
+        return self.pc.Index((spec or self.get_topic_spec(index_name))["index"])
+
+    def topic_filter(self, index_name, spec=None, **conditions):
+        """Builds a metadata filter, scoped to the given topic when it lives in the shared index."""
+        if self.in_shared_index(spec or self.get_topic_spec(index_name)):
+            conditions["topic"] = {"$eq": index_name}
+        return conditions
+
+    def vector_id_prefix(self, index_name, spec=None):
+        return f"{index_name}#" if self.in_shared_index(spec or self.get_topic_spec(index_name)) else ""
+
+    def list_vector_ids(self, index, prefix="", namespace="docs"):
+        return [vector_id for ids in index.list(prefix=prefix, namespace=namespace) for vector_id in ids]
+
+    def fetch_vectors(self, index, ids, namespace="docs"):
+        """Yields (id, values, metadata) for the given ids, fetched in batches."""
+        for start in range(0, len(ids), FETCH_BATCH_SIZE):
+            response = index.fetch(ids=ids[start:start + FETCH_BATCH_SIZE], namespace=namespace)
+            for vector_id, vector in response.vectors.items():
+                yield vector_id, list(vector.get("values", [])), dict(vector.get("metadata", {}) or {})
+
+    def delete_vectors_by_prefix(self, index, prefix, namespace="docs"):
+        ids = self.list_vector_ids(index, prefix, namespace)
+        for start in range(0, len(ids), FETCH_BATCH_SIZE):
+            index.delete(ids=ids[start:start + FETCH_BATCH_SIZE], namespace=namespace)
+
+    def delete_vectors_by_source(self, index_name, file_name, spec=None):
+        self.ensure_not_migrating(index_name)
+        spec = spec or self.get_topic_spec(index_name)
+        index = self.topic_index(index_name, spec)
         query_result = index.query(
-            vector=[0] * 1536,
+            vector=[0] * spec["dimension"],
             namespace="docs",
             top_k=1000,
-            filter={"source": {"$eq": file_name}}
+            filter=self.topic_filter(index_name, spec, source={"$eq": file_name})
         )
         chunk_ids = [match["id"] for match in query_result.get("matches", [])]
         if chunk_ids:
             index.delete(ids=chunk_ids, namespace="docs")
 
-    def is_embedded(self, index_name, file_name, namespace="docs"):
+    def is_embedded(self, index_name, file_name, namespace="docs", spec=None):
         """
         Searches all non-table-of-contents indexes for the given file name.
         Returns the index name where the file is embedded, or None if not found.
+        Pass the topic's `spec` when checking many files to look it up only once.
         """
-        index = self.pc.Index(index_name)
         try:
+            spec = spec or self.get_topic_spec(index_name)
+            index = self.topic_index(index_name, spec)
             query_result = index.query(
-                vector=[0] * 1536,
+                vector=[0] * spec["dimension"],
                 namespace=namespace,
                 top_k=1,
-                filter={"source": {"$eq": file_name}},
+                filter=self.topic_filter(index_name, spec, source={"$eq": file_name}),
                 include_metadata=True
             )
             return True if query_result.get("matches") else False
@@ -117,33 +246,113 @@ class PineconeManager:
             print(f"Error checking embedding status of {file_name} in {index_name}")
             return False
 
-    def upsert_vectors(self, index_name, src_doc, file_paths, chunks, embed_type, namespace="docs"):
-        pc_vectors = [
-            {
-                "id": f"{src_doc}-{embed_type}-{i}",
-                "values": get_embedding(chunk),
-                "metadata": {
-                    "content": chunk,
-                    "source": src_doc,
-                    "file_path": file_paths[i],
-                    "type": embed_type
-                }
-            }
+    def is_migrating(self, index_name):
+        """Whether the topic is being re-embedded by any worker (see migration_store.py)."""
+        return migration_store.is_migrating(index_name)
+
+    def ensure_not_migrating(self, index_name):
+        # Topics being re-embedded refuse new vectors and deletes until they switch over.
+        if self.is_migrating(index_name):
+            raise migration_store.MigrationInProgress(f"'{index_name}' is being re-embedded; try again once the migration finishes.")
+
+    def chunk_vector(self, src_doc, embed_type, i, chunk, file_path, embedding):
+        """Builds the layout-independent (id, values, metadata) record for chunk `i` of a document."""
+        return f"{src_doc}-{embed_type}-{i}", embedding, {
+            "content": chunk,
+            "source": src_doc,
+            "file_path": file_path,
+            "type": embed_type,
+            "chunk_index": i
+        }
+
+    def upsert_vectors(self, index_name, src_doc, file_paths, chunks, embed_type, namespace="docs", blob_dir=None):
+        """Embeds and upserts chunks; embeddings are reused from the document's blob when it has them."""
+        self.ensure_not_migrating(index_name)
+        spec = self.get_topic_spec(index_name)
+        embeddings = cached_embeddings(blob_dir, chunks, spec["embedding_model"], spec["dimension"])
+        self.import_vectors(index_name, [
+            self.chunk_vector(src_doc, embed_type, i, chunk, file_paths[i], embeddings[i])
             for i, chunk in enumerate(chunks)
-        ]
-        index = self.pc.Index(index_name)
-        index.upsert(vectors=pc_vectors, namespace=namespace)
-
-    def query_at_index(self, index_name, query, top_k=5):
-        """Queries the specified index using the embedded query and returns list of metadata contents."""
-        embedding = get_embedding(query)
-        index = self.pc.Index(index_name)
-        results = index.query(
-            vector=embedding,
-            top_k=top_k,
-            namespace="docs",
-            include_metadata=True
-        )
-        return [match.get("metadata", {}) for match in results.get("matches", [])]
+        ], namespace, spec=spec)
+
+    def topic_metadata(self, index_name, spec=None):
+        return {"topic": index_name} if self.in_shared_index(spec or self.get_topic_spec(index_name)) else {}
+
+    def export_vectors(self, index_name, namespace="docs"):
+        """Yields (id, values, metadata) for every vector of a topic, independent of the storage layout."""
+        spec = self.get_topic_spec(index_name)
+        index = self.topic_index(index_name, spec)
+        prefix = self.vector_id_prefix(index_name, spec)
+        for vector_id, values, metadata in self.fetch_vectors(index, self.list_vector_ids(index, prefix, namespace), namespace):
+            metadata.pop("topic", None)
+            yield vector_id[len(prefix):], values, metadata
+
+    def import_vectors(self, index_name, vectors, namespace="docs", batch_size=FETCH_BATCH_SIZE, spec=None):
+        """Upserts already-embedded (id, values, metadata) vectors into a topic in batches."""
+        spec = spec or self.get_topic_spec(index_name)
+        index = self.topic_index(index_name, spec)
+        prefix = self.vector_id_prefix(index_name, spec)
+        topic_metadata = self.topic_metadata(index_name, spec)
+        batch = []
+        count = 0
+        for vector_id, values, metadata in vectors:
+            batch.append({"id": f"{prefix}{vector_id}", "values": values,
+                          "metadata": {**metadata, **topic_metadata}})
+            if len(batch) >= batch_size:
+                index.upsert(vectors=batch, namespace=namespace)
+                count += len(batch)
+                batch = []
+        if batch:
+            index.upsert(vectors=batch, namespace=namespace)
+            count += len(batch)
+        return count
+
+    def query_at_index(self, index_name, query, top_k=RETRIEVAL_TOP_K):
+        """Queries the specified index using the embedded query and returns list of metadata contents with their scores."""
+        return self.query_topics([index_name], query, top_k)
+
+    def query_topics(self, index_names, query, top_k=RETRIEVAL_TOP_K, specs=None):
+        """
+        Queries every given topic for the embedded query, returning at most
+        top_k matches per topic. Topics in the shared index are searched
+        together in a single filtered request, which asks for top_k per topic
+        and then caps each topic's share, so one topic cannot take every slot
+        (a topic may still end up with fewer than top_k).
+        """
+        if not index_names:
+            return []
+        if specs is None:
+            specs = self.get_topic_specs(index_names)
+        shared = [index_name for index_name in index_names if self.in_shared_index(specs[index_name])]
+        requests = [(self.pc.Index(specs[index_name]["index"]), specs[index_name], None, top_k)
+                    for index_name in index_names if index_name not in shared]
+        if shared:
+            requests.append((self.pc.Index(SHARED_INDEX), specs[shared[0]],
+                             {"topic": {"$in": shared}}, top_k * len(shared)))
+
+        # Topics embedded with different models need their own query embedding.
+        embeddings = {}
+        matches = []
+        for index, spec, metadata_filter, request_top_k in requests:
+            key = (spec["embedding_model"], spec["dimension"])
+            if key not in embeddings:
+                embeddings[key] = get_embedding(query, *key)
+            results = index.query(
+                vector=embeddings[key],
+                top_k=request_top_k,
+                namespace="docs",
+                filter=metadata_filter,
+                include_metadata=True
+            )
+            matches += [{**match.get("metadata", {}), "score": match.get("score")} for match in results.get("matches", [])]
+
+        kept = []
+        per_topic = {}
+        for match in matches:
+            topic = match.get("topic")
+            per_topic[topic] = per_topic.get(topic, 0) + 1
+            if topic is None or per_topic[topic] <= top_k:
+                kept.append(match)
+        return kept
 
 vector_store_manager = PineconeManager()
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""
+Opt-in sampling profiler for live requests.
+
+While a profile runs, a background thread takes a snapshot of the Python
+stack of the request's thread, and of every thread started since the
+profile began (ingestion workers, batch workers, ...), every
+PROFILE_INTERVAL_MS milliseconds. Identical stacks are counted and written
+to PROFILE_DIR in the collapsed-stack format ("frame;frame;frame count" per
+line), which flamegraph.pl, speedscope and similar tools turn into a
+flame graph. Nothing is sampled unless a profile is running, so an idle
+profiler costs nothing.
+
+Profiles are requested for the next N requests with arm(), or for a single
+request through a header checked by the app. The counter is per process.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+# Deepest frames kept per sample, so runaway recursion cannot bloat a profile.
+MAX_STACK_DEPTH = 200
+
+_armed_lock = threading.Lock()
+_armed = {}
+
+
+def arm(endpoints, count):
+    """Profiles the next `count` requests to each of the given endpoints."""
+    with _armed_lock:
+        for endpoint in endpoints:
+            _armed[endpoint] = max(0, int(count))
+        return dict(_armed)
+
+
+def armed():
+    with _armed_lock:
+        return {endpoint: count for endpoint, count in _armed.items() if count}
+
+
+def take_armed(endpoint):
+    """Uses up one armed profile for the endpoint, returning whether one was available."""
+    with _armed_lock:
+        if _armed.get(endpoint, 0) > 0:
+            _armed[endpoint] -= 1
+            return True
+        return False
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the stacks of one thread and of the threads it starts, until stop() is called."""
+
+    def __init__(self, thread_id=None, interval_ms=PROFILE_INTERVAL_MS):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval_ms / 1000
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        # Threads that already exist belong to other requests or the server.
+        self._ignored = {thread.ident for thread in threading.enumerate()} - {self.thread_id}
+        self.started = time.perf_counter()
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or thread_id in self._ignored:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                root = "request" if thread_id == self.thread_id else names.get(thread_id, f"thread-{thread_id}")
+                key = ";".join([root] + stack[::-1])
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        """The profile in collapsed-stack format, heaviest stacks first."""
+        lines = [f"{stack} {count}" for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1])]
+        return "\n".join(lines) + "\n"
+
+    def save(self, label, directory=PROFILE_DIR):
+        """Writes the profile to `directory` and returns the file name."""
+        os.makedirs(directory, exist_ok=True)
+        safe_label = re.sub(r"[^A-Za-z0-9_-]+", "-", label).strip("-") or "request"
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        file_name = f"{timestamp}-{safe_label}-{round(self.elapsed * 1000)}ms.collapsed"
+        with open(os.path.join(directory, file_name), "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        return file_name
+
+
+def list_profiles(directory=PROFILE_DIR):
+    """Saved profiles, newest first, as dictionaries with name, size and creation time."""
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for file_name in os.listdir(directory):
+        if file_name.endswith(".collapsed"):
+            stat = os.stat(os.path.join(directory, file_name))
+            profiles.append({"name": file_name, "size": stat.st_size, "created": stat.st_mtime})
+    return sorted(profiles, key=lambda profile: -profile["created"])
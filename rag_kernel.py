@@ -1,7 +1,7 @@
 # === Base imports ===
 import asyncio
 from typing import Annotated
-import ast
+import json
 import re
 from semantic_kernel.connectors.ai.function_choice_behavior import FunctionChoiceBehavior
 from semantic_kernel.connectors.ai.open_ai import OpenAIChatCompletion
@@ -13,38 +13,56 @@ from semantic_kernel.contents.chat_history import ChatHistory
 from semantic_kernel.contents import ChatMessageContent
 from semantic_kernel.contents.utils.author_role import AuthorRole
 from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextvars
 import os
+import queue
+import time
 
 # === Custom module imports ===
-from helpers import OPENAI_API_KEY, client as turbo_client, encode_image, UPLOAD_FOLDER
-from pinecone_utils import vector_store_manager
+from helpers import (OPENAI_API_KEY,
+                     client as turbo_client,
+                     encode_image,
+                     file_version,
+                     thumbnail_path,
+                     embedding_memo,
+                     EmbeddingMemo,
+                     UPLOAD_FOLDER,
+                     CONTEXT_TOKEN_BUDGET,
+                     QUERY_BATCH_CONCURRENCY)
+from context_packer import pack_context
+from request_context import get_request_context, request_scope, TopicSelection, RetrievedContext
+import session_store
 
-# === Initialize Kernel & Planner Globally ===
-"""
-The kernel acts as the central hub of various services, planners, and
-plugins, which can then be invoked or used at various times.
-"""
-kernel = Kernel()
 service_id = "chat"
 ai_model_id = "gpt-4o"
-ai_service = OpenAIChatCompletion(service_id=service_id, api_key=OPENAI_API_KEY, ai_model_id=ai_model_id)
-kernel.add_service(ai_service)
 
-# === Initialize the Planner ===
+# === Chat History ===
 """
-Planners are what we can use to intelligently construct sequences of method calls
-based on a user's goal. Right now, we're using a sequential planner, but others
-exist. This will be how we handle sending our query through a sequence of methods
-without explicitly defining what that sequence is.
+Conversation history is not kept in this process: each session's messages
+are loaded from session_store when its query starts and its new messages
+are written back when the answer is ready, so any worker can serve any
+session. The kernels and planners below hold no per-conversation state.
 """
-planner = SequentialPlanner(kernel, service_id=service_id)
-settings = kernel.get_prompt_execution_settings_from_service_id(service_id=service_id)
-settings.function_choice_behavior = FunctionChoiceBehavior.Auto(filters={"included_plugins": ["QueryResponse"]})
-
-# === Initialize Chat History ===
-chat_history = ChatHistory()
 
 # === Define Custom Plugin Classes ===
+GENERAL_KNOWLEDGE_REQUEST = "No relevant context found"
+NO_INFORMATION_FOUND = "no_information_found"
+
+def parse_topic_list(text) -> list[str]:
+    """Reads topic names from a JSON list, or from the looser list formats a model may reply with."""
+    text = str(text).strip()
+    try:
+        value = json.loads(text)
+        if isinstance(value, list):
+            return [str(topic) for topic in value]
+    except ValueError:
+        pass
+    match = re.search(r"\[(.*?)\]", text, re.S)
+    if not match:
+        return []
+    return [single or double for single, double in re.findall(r"'([^']*)'|\"([^\"]*)\"", match.group(1))]
+
 class QueryPlugin:
     """
     Plugin for handling user queries, retrieving topic-relevant chunks,
@@ -57,27 +75,26 @@ class QueryPlugin:
             self,
             kernel: Kernel,
             query: Annotated[str, "The conversation and user's latest query"],
-            topics: Annotated[str, "A stringified list of topics that was supplied by the user directly. This can either be empty, signaling us to choose the topics most related to the query ourselves, or it could contain a preselected list of topics to use."],
-            # topics_descriptions: Annotated[str, "A stringified dictionary of topics and descriptions"]
-    ) -> Annotated[str, "Stringified list of most relevant topic names, or 'general' if none are applicable"]:
-        topics = ast.literal_eval(topics)
-        if len(topics):
-            return str(topics)
-
-        # topics_dict = ast.literal_eval(topics_descriptions)
+            topics: Annotated[str, "A JSON list of topics that was supplied by the user directly. This can either be empty, signaling us to choose the topics most related to the query ourselves, or it could contain a preselected list of topics to use."],
+    ) -> Annotated[str, "JSON list of most relevant topic names, or 'general' if none are applicable"]:
+        request_context = get_request_context()
+        user_topics = parse_topic_list(topics)
+        if user_topics:
+            return request_context.hand_off(TopicSelection(user_topics), json.dumps(user_topics))
+
         prompt = f"""
         Given the following topics and their descriptions:
         
-        {vector_store_manager.get_descriptions()}
+        {request_context.descriptions()}
         
         compare the content of the query with the descriptions
         of the topics and select the ones most relevant to
         answering the query: "{query}".
         
-        Be sure to ONLY return a list formatted like: ['Topic1', 'Topic2']".
+        Be sure to ONLY return a JSON list formatted like: ["Topic1", "Topic2"].
         Do NOT add any trailing whitespaces, extra quotation marks,
-        or 'python' tags or anything like that
-        If none are applicable, return ['general'].
+        or 'json' tags or anything like that
+        If none are applicable, return ["general"].
         """
 
         settings = kernel.get_prompt_execution_settings_from_service_id(service_id="chat")
@@ -87,91 +104,92 @@ class QueryPlugin:
             prompt=prompt,
             settings=settings,
         )
-        return response
+        # The reply is parsed once here; later steps receive the parsed list.
+        selected = parse_topic_list(response)
+        return request_context.hand_off(TopicSelection(selected), json.dumps(selected))
 
     @kernel_function(name="retrieve_context_chunks",
                      description="Retrieve relevant chunks from Pinecone indices, including images.")
     async def retrieve_context_chunks(
             self,
             kernel: Kernel,
-            found_topics: Annotated[str, "Stringified list of relevant topic names that have been selected to best answer the query"],
+            found_topics: Annotated[str, "JSON list of relevant topic names that have been selected to best answer the query"],
             query: Annotated[str, "The user query"],
             use_general_knowledge: Annotated[str, "Whether to fall back to general knowledge"]
-    ) -> Annotated[str, "Stringified list of retrieved text/image descriptions and image paths"]:
+    ) -> Annotated[str, "Handle to the retrieved text/image descriptions and image paths"]:
 
-        general_knowledge_request = "No relevant context found"
-        no_information_found = "no_information_found"
+        use_general = use_general_knowledge.lower() == "true"
+        fallback = GENERAL_KNOWLEDGE_REQUEST if use_general else NO_INFORMATION_FOUND
+        request_context = get_request_context()
+        selection = request_context.receive(found_topics, TopicSelection)
+        found_list = selection.topics if selection else parse_topic_list(found_topics)
 
-        def find_valid_list(text):
-            match = re.search(r"\[\s*(?:'[^']*'(?:\s*,\s*'[^']*')*)?\s*\]", text)
-            return match.group(0) if match else None
+        if not found_list or found_list == ['general']:
+            return fallback
 
-        found_list_str = find_valid_list(found_topics)
-        if not found_list_str:
-            return general_knowledge_request if use_general_knowledge.lower() == "true" else no_information_found
-
-        try:
-            found_list = ast.literal_eval(found_list_str)
-        except Exception:
-            return no_information_found
-
-        if found_list == ['general']:
-            return general_knowledge_request if use_general_knowledge.lower() == "true" else no_information_found
-
-        if use_general_knowledge.lower() != "true":
+        if not use_general:
             found_list = [topic for topic in found_list if topic.lower() != 'general']
             if not found_list:
-                return no_information_found
+                return NO_INFORMATION_FOUND
 
         context_texts = []
         image_paths = []
         file_links = []
-        existing_indexes = vector_store_manager.list_indexes()
-
-        for topic in found_list:
-            if topic not in existing_indexes:
-                continue
-            metadata_list = vector_store_manager.query_at_index(topic, query)
-            for metadata in metadata_list:
-                chunk_type = metadata.get("type", "text")
-                content = metadata.get("content", "")
-                file_path = metadata.get("file_path").replace("\\", "/")
-
-                if file_path.startswith(f"{UPLOAD_FOLDER}/"):
-                    relative_path = file_path[len(f"{UPLOAD_FOLDER}/"):]
-                else:
-                    relative_path = file_path
-                url_path = f"/{UPLOAD_FOLDER}/{quote(relative_path)}"
-                filename = os.path.basename(file_path)
-                markdown_link = f"[{filename}]({url_path})"
-
-                if chunk_type == "image":
-                    image_paths.append(file_path)
-
-                context_texts.append(f"{content}\nSource URL: {markdown_link}")
-                file_links.append(markdown_link)
+        existing_indexes = request_context.topics()
+
+        topics_to_search = [topic for topic in found_list if topic in existing_indexes]
+        retrieved = request_context.retrieve(topics_to_search, query) if topics_to_search else []
+
+        # Overlapping windows from the same document are stitched back
+        # together and trimmed to the prompt budget before formatting.
+        metadata_list, packing_stats = pack_context(retrieved, CONTEXT_TOKEN_BUDGET)
+
+        for metadata in metadata_list:
+            chunk_type = metadata.get("type", "text")
+            content = metadata.get("content", "")
+            file_path = metadata.get("file_path").replace("\\", "/")
+
+            if file_path.startswith(f"{UPLOAD_FOLDER}/"):
+                relative_path = file_path[len(f"{UPLOAD_FOLDER}/"):]
+            else:
+                relative_path = file_path
+            url_path = f"/{UPLOAD_FOLDER}/{quote(relative_path)}"
+            # Versioned links let the browser cache files across answers.
+            if os.path.exists(file_path):
+                url_path += f"?v={file_version(file_path)}"
+                if chunk_type == "image" and os.path.exists(thumbnail_path(file_path)):
+                    url_path += "&variant=thumb"
+            filename = os.path.basename(file_path)
+            markdown_link = f"[{filename}]({url_path})"
+
+            if chunk_type == "image":
+                image_paths.append(file_path)
+
+            context_texts.append(f"{content}\nSource URL: {markdown_link}")
+            file_links.append(markdown_link)
 
         if not context_texts and not image_paths:
-            return general_knowledge_request if use_general_knowledge.lower() == "true" else no_information_found
+            return fallback
 
-        return str({"text_chunks": context_texts, "image_paths": image_paths, "file_links": file_links})
+        return request_context.hand_off(RetrievedContext(context_texts, image_paths, file_links, packing_stats))
 
     @kernel_function(name="answer_query",
                      description="Answer the user query with retrieved context, including images if available.")
     async def answer_query(
             self,
+            kernel: Kernel,
             query: Annotated[str, "The user query"],
-            retrieved_data: Annotated[str, "Stringified dictionary containing relevant text_chunks and image_paths"]
+            retrieved_data: Annotated[str, "Handle to the retrieved text chunks and image paths"]
     ) -> Annotated[str, "Final answer to the user query"]:
 
-        if retrieved_data == "no_information_found":
+        if retrieved_data == NO_INFORMATION_FOUND:
             return (
                 "❌ Sorry, we couldn’t find any relevant topics or matching content "
                 "in your uploaded documents to answer your question. Please try rephrasing "
                 "your query or uploading new sources."
             )
 
-        if retrieved_data == "No relevant context found":
+        if retrieved_data == GENERAL_KNOWLEDGE_REQUEST:
             prompt = f"Answer the following question using your general knowledge:\n\nQuery: {query}"
             settings = kernel.get_prompt_execution_settings_from_service_id(service_id="chat")
             response = await kernel.invoke_prompt(
@@ -182,14 +200,13 @@ class QueryPlugin:
             )
             return response
 
-        try:
-            retrieved_dict = ast.literal_eval(retrieved_data)
-        except Exception:
+        retrieved = get_request_context().receive(retrieved_data, RetrievedContext)
+        if retrieved is None:
             return "⚠️ Error reading retrieved data format. Please retry."
 
-        text_chunks = retrieved_dict.get("text_chunks", [])
-        image_paths = retrieved_dict.get("image_paths", [])
-        file_links = list(set(retrieved_dict.get("file_links", [])))
+        text_chunks = retrieved.text_chunks
+        image_paths = retrieved.image_paths
+        file_links = list(set(retrieved.file_links))
 
         encoded_images = []
         for img_path in image_paths:
@@ -254,22 +271,66 @@ class QueryPlugin:
 
         return final_answer#final_response
 
-# === Add Plugins to the Kernel ===
-kernel.add_plugin(QueryPlugin(), plugin_name="QueryResponse",
-                  description="""
+# === Initialize Kernel & Planner ===
+"""
+The kernel acts as the central hub of various services, planners, and
+plugins, which can then be invoked or used at various times.
+
+Planners are what we can use to intelligently construct sequences of method calls
+based on a user's goal. Right now, we're using a sequential planner, but others
+exist. This will be how we handle sending our query through a sequence of methods
+without explicitly defining what that sequence is.
+
+The chat service's async HTTP client belongs to the event loop it first ran
+on, so a kernel cannot be shared by queries running on different loops at
+once. Each KernelRuntime pairs a kernel and planner with its own event loop;
+queries borrow an idle runtime and return it when done, so runtimes (about
+50 ms to build) are reused and only as many exist as queries ever ran at once.
+"""
+class KernelRuntime:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.kernel = Kernel()
+        self.kernel.add_service(OpenAIChatCompletion(service_id=service_id, api_key=OPENAI_API_KEY,
+                                                     ai_model_id=ai_model_id))
+        # === Add Plugins to the Kernel ===
+        self.kernel.add_plugin(QueryPlugin(), plugin_name="QueryResponse",
+                               description="""
                   For question-answering related functions 
                   for identifying and selecting relevant 
                   topics for answering a query, retrieval of 
                   relevant content for context based on
                   those selected topics, answering 
                   user queries, and formatting the responses"""
-                  )
-kernel.add_plugin(TextPlugin(), plugin_name="text")
-
-
-async def run_query_pipeline(user_query: str, topics: list[str], use_general_knowledge: bool):
+                               )
+        self.kernel.add_plugin(TextPlugin(), plugin_name="text")
+        self.planner = SequentialPlanner(self.kernel, service_id=service_id)
+        settings = self.kernel.get_prompt_execution_settings_from_service_id(service_id=service_id)
+        settings.function_choice_behavior = FunctionChoiceBehavior.Auto(filters={"included_plugins": ["QueryResponse"]})
+
+    def run(self, user_query: str, topics: list[str], use_general_knowledge: bool, history: ChatHistory):
+        """Answers a query on this runtime's loop, from whichever thread borrowed it. Returns (answer, context_stats)."""
+        return self.loop.run_until_complete(
+            run_query_pipeline(self, user_query, topics, use_general_knowledge, history))
+
+_idle_runtimes = queue.SimpleQueue()
+
+def run_on_kernel(user_query: str, topics: list[str], use_general_knowledge: bool, history: ChatHistory):
+    """Runs the query pipeline on an idle KernelRuntime, creating one if every runtime is busy."""
+    try:
+        runtime = _idle_runtimes.get_nowait()
+    except queue.Empty:
+        runtime = KernelRuntime()
+    try:
+        return runtime.run(user_query, topics, use_general_knowledge, history)
+    finally:
+        _idle_runtimes.put(runtime)
+
+
+async def run_query_pipeline(runtime: KernelRuntime, user_query: str, topics: list[str],
+                             use_general_knowledge: bool, history: ChatHistory):
     history_text = "\n".join(
-        f"{msg.role.value}: {msg.content}" for msg in chat_history.messages
+        f"{msg.role.value}: {msg.content}" for msg in history.messages
     )
     full_prompt = f"""
     This is the prior messages exchanged in a conversation:
@@ -280,7 +341,7 @@ async def run_query_pipeline(user_query: str, topics: list[str], use_general_kno
     
     User Query: {user_query}
     """
-    chat_history.add_message(ChatMessageContent(role=AuthorRole.USER, content=user_query))
+    history.add_message(ChatMessageContent(role=AuthorRole.USER, content=user_query))
     goal_prompt = f"""
     Ingest the prior conversation and the current user query,
     then -if a list of topics haven't been provided by the user-,
@@ -292,31 +353,121 @@ async def run_query_pipeline(user_query: str, topics: list[str], use_general_kno
     the final response is in proper markdown format and
     cleaned up for display.
     """
-    plan = await planner.create_plan(goal_prompt)
-    execution_result = await plan.invoke(kernel, {
-        "query": full_prompt,
-        "topics": str(topics),
-        "use_general_knowledge": str(use_general_knowledge)
-    })
-    chat_history.add_message(ChatMessageContent(role=AuthorRole.ASSISTANT, content=execution_result.value))
-    return execution_result.value
-
-def run_query(user_query: str, topics: list[str], use_general_knowledge: bool = True):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    response = loop.run_until_complete(run_query_pipeline(user_query, topics, use_general_knowledge))
-    return response
-
-def clear_sk_memory():
-    """Clears the stored conversation history in SK's built-in text memory."""
-    chat_history.clear()
-
-def get_chat_history():
-    """Returns the chat history as a list of dictionaries with role and content."""
-    return [
-        {"role": msg.role.value, "content": msg.content}
-        for msg in chat_history.messages
-    ]
+    plan = await runtime.planner.create_plan(goal_prompt)
+    # Every plugin step of this query shares one embedding of the prompt and
+    # one snapshot of the topic registry.
+    with request_scope() as request_context:
+        execution_result = await plan.invoke(runtime.kernel, {
+            "query": full_prompt,
+            "topics": json.dumps(topics),
+            "use_general_knowledge": str(use_general_knowledge)
+        })
+    history.add_message(ChatMessageContent(role=AuthorRole.ASSISTANT, content=execution_result.value))
+    return execution_result.value, request_context.context_stats()
+
+def load_session_history(session_id: str = None) -> ChatHistory:
+    """Builds a ChatHistory from the session's stored messages (empty without a session)."""
+    history = ChatHistory()
+    for message in session_store.load_messages(session_id) if session_id else []:
+        history.add_message(ChatMessageContent(role=AuthorRole(message["role"]), content=message["content"]))
+    return history
+
+def run_query(user_query: str, topics: list[str], use_general_knowledge: bool = True, session_id: str = None):
+    """
+    Answers a query within the session's conversation. Returns (response,
+    context_stats), the latter describing how the retrieved context was packed
+    (chunks merged and dropped, tokens saved); it is empty when nothing was retrieved.
+    """
+    history = load_session_history(session_id)
+    response, context_stats = run_on_kernel(user_query, topics, use_general_knowledge, history)
+    if session_id:
+        session_store.append_messages(session_id, [
+            (AuthorRole.USER.value, user_query),
+            (AuthorRole.ASSISTANT.value, str(response)),
+        ])
+    return response, context_stats
+
+def _run_batch_item(item):
+    """Answers one batch question on the calling thread, without any conversation history."""
+    response, context_stats = run_on_kernel(item["query"], item["topics"], item["use_general_knowledge"], ChatHistory())
+    return str(response), context_stats
+
+def normalize_batch_item(item: dict) -> dict:
+    """
+    Validates one query_batch item and returns its query, topics and
+    use_general_knowledge in canonical form. Raises ValueError on bad input
+    rather than coercing it, so "false" never counts as true and a topic
+    given as a string is not split into characters.
+    """
+    if not isinstance(item, dict) or not isinstance(item.get("query"), str) or not item["query"].strip():
+        raise ValueError("Each query needs non-empty query text.")
+    topics = item.get("topics", [])
+    if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+        raise ValueError("\"topics\" must be a list of topic names.")
+    use_general_knowledge = item.get("use_general_knowledge", True)
+    if isinstance(use_general_knowledge, str) and use_general_knowledge.lower() in ("true", "false"):
+        use_general_knowledge = use_general_knowledge.lower() == "true"
+    if not isinstance(use_general_knowledge, bool):
+        raise ValueError("\"use_general_knowledge\" must be true or false.")
+    return {"query": item["query"], "topics": topics, "use_general_knowledge": use_general_knowledge}
+
+def run_query_batch(items: list[dict], max_concurrency: int = QUERY_BATCH_CONCURRENCY):
+    """
+    Answers many independent questions concurrently, yielding one result per
+    item as soon as it is ready. Each item is a dictionary with a "query" and
+    optional "topics", "use_general_knowledge" and "id". Identical questions
+    are answered once, and query embeddings are shared across the batch. At
+    most QUERY_BATCH_CONCURRENCY questions run at once, whatever is asked for.
+    """
+    max_concurrency = max(1, min(int(max_concurrency), QUERY_BATCH_CONCURRENCY))
+    # The memo is installed in a context private to the batch, so it never
+    # leaks into the calling thread.
+    batch_context = contextvars.copy_context()
+    batch_context.run(embedding_memo.set, EmbeddingMemo())
+    groups = {}
+    for position, item in enumerate(items):
+        normalized = normalize_batch_item(item)
+        key = (normalized["query"], tuple(normalized["topics"]), normalized["use_general_knowledge"])
+        groups.setdefault(key, (normalized, []))[1].append((position, item.get("id", position)))
+
+    def timed(item, submitted):
+        started = time.perf_counter()
+        try:
+            (response, context_stats), error = _run_batch_item(item), None
+        except Exception as e:
+            response, context_stats, error = None, {}, str(e)
+        finished = time.perf_counter()
+        return response, context_stats, error, {
+            "queued_ms": round((started - submitted) * 1000, 1),
+            "run_ms": round((finished - started) * 1000, 1),
+        }
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {}
+        for normalized, members in groups.values():
+            # A context can only be entered by one thread at a time, so each
+            # worker gets its own copy; the copies share the same memo.
+            future = executor.submit(batch_context.copy().run, timed, normalized, time.perf_counter())
+            futures[future] = (normalized, members)
+        for future in as_completed(futures):
+            normalized, members = futures[future]
+            response, context_stats, error, timings = future.result()
+            for position, item_id in members:
+                result = {"index": position, "id": item_id, "query": normalized["query"],
+                          "timings": timings, "context_stats": context_stats, "deduplicated": len(members) > 1}
+                if error is None:
+                    result["response"] = response
+                else:
+                    result["error"] = error
+                yield result
+
+def clear_sk_memory(session_id: str):
+    """Clears the session's stored conversation history."""
+    session_store.clear_messages(session_id)
+
+def get_chat_history(session_id: str):
+    """Returns the session's chat history as a list of dictionaries with role and content."""
+    return session_store.load_messages(session_id)
 
 
 """
@@ -326,5 +477,4 @@ database to use the below lines correctly.
 """
 # if __name__ == "__main__":
 #      user_query = input("User query: ")
-#      print(asyncio.run(run_query_pipeline(user_query)))
-#      clear_sk_memory()
+#      print(run_query(user_query, [])[0])
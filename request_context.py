@@ -0,0 +1,111 @@
+"""
+Per-request state shared by the QueryPlugin steps.
+
+A single answered query runs several plugin functions chosen by the
+planner, each of which used to fetch what it needed on its own: the query
+embedding once per topic, the topic descriptions, the list of topics. A
+RequestContext holds those remote artifacts for the lifetime of one query
+so each is computed at most once. run_query_pipeline() installs one in
+`current_request` for the duration of the plan.
+
+The planner can only pass strings from one step to the next, so steps hand
+their results over through the context: a step stores its result object
+with hand_off() and returns a short string for the planner to pass along,
+and the next step gets the object back with receive() instead of parsing
+text.
+"""
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from helpers import EmbeddingMemo, embedding_memo, RETRIEVAL_TOP_K
+from pinecone_utils import vector_store_manager
+
+
+@dataclass
+class TopicSelection:
+    """The topics to retrieve from, as chosen by the user or by the model."""
+    topics: list
+
+
+@dataclass
+class RetrievedContext:
+    """Packed chunks retrieved for a query, ready to be put into the answer prompt."""
+    text_chunks: list = field(default_factory=list)
+    image_paths: list = field(default_factory=list)
+    file_links: list = field(default_factory=list)
+    context_stats: dict = field(default_factory=dict)
+
+
+class RequestContext:
+    def __init__(self, memo=None):
+        # Query embeddings go through the memo, which may be shared with a batch.
+        self.embeddings = memo or EmbeddingMemo()
+        self.lock = threading.Lock()
+        self._registry = None
+        self.retrieved = {}
+        self.handoffs = {}
+
+    def registry(self):
+        """Snapshot of {topic: table-of-contents metadata}, fetched once per request."""
+        with self.lock:
+            if self._registry is None:
+                self._registry = vector_store_manager.get_registry()
+            return self._registry
+
+    def topics(self):
+        return list(self.registry())
+
+    def descriptions(self):
+        return vector_store_manager.get_descriptions(self.registry())
+
+    def retrieve(self, topics, query, top_k=RETRIEVAL_TOP_K):
+        """Retrieves chunks for the topics and query, reusing earlier results within the request."""
+        key = (tuple(topics), query, top_k)
+        if key not in self.retrieved:
+            specs = vector_store_manager.get_topic_specs(topics, self.registry())
+            self.retrieved[key] = vector_store_manager.query_topics(list(topics), query, top_k, specs)
+        return self.retrieved[key]
+
+    def hand_off(self, value, text=None):
+        """
+        Keeps a step's result for the following steps and returns the string
+        the planner should pass along: `text` if given, otherwise a short handle.
+        """
+        with self.lock:
+            text = text or f"<{type(value).__name__} {len(self.handoffs) + 1}>"
+            self.handoffs[text] = value
+        return text
+
+    def receive(self, text, expected_type):
+        """Returns the object handed off under `text`, or None if there is none of that type."""
+        value = self.handoffs.get(str(text).strip())
+        return value if isinstance(value, expected_type) else None
+
+    def context_stats(self):
+        """Packing statistics of the latest context retrieved in this request, or {} if none was."""
+        with self.lock:
+            retrieved = [value for value in self.handoffs.values() if isinstance(value, RetrievedContext)]
+        return retrieved[-1].context_stats if retrieved else {}
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+def get_request_context():
+    """Returns the active request's context, or a throwaway one outside of a request."""
+    return current_request.get() or RequestContext(embedding_memo.get())
+
+
+@contextmanager
+def request_scope():
+    """Installs a fresh RequestContext (and its embedding memo) for the enclosed block."""
+    context = RequestContext(embedding_memo.get())
+    context_token = current_request.set(context)
+    memo_token = embedding_memo.set(context.embeddings)
+    try:
+        yield context
+    finally:
+        embedding_memo.reset(memo_token)
+        current_request.reset(context_token)
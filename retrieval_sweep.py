@@ -0,0 +1,191 @@
+"""
+Sweeps chunk_size, overlap and top_k against a labeled question set, so they
+can be chosen by numbers instead of by guess.
+
+Documents are chunked and embedded into an offline in-memory store (no
+Pinecone index is touched). Embeddings are cached on disk by model,
+dimension and text, so repeated sweeps only pay for chunks they have not
+seen before. For every configuration the sweep reports:
+
+    recall@k          share of questions with a relevant chunk in the top k
+    mrr               mean reciprocal rank of the first relevant chunk
+    vectors_per_doc   chunks stored per document
+    embedding_tokens  estimated tokens needed to embed the whole set once
+    context_tokens    average estimated prompt tokens after context packing
+    latency_ms        average / p95 search time per question (embedding excluded)
+
+The question file is a JSON list such as:
+    [{"question": "When was the bridge finished?", "source": "history.pdf", "answer": "1932"}]
+A chunk counts as relevant when it comes from one of the question's sources
+("source" or "sources") and, if an "answer" is given, contains it.
+
+Usage:
+    python retrieval_sweep.py questions.json docs/ --chunk-sizes 250,500 --overlaps 0,125,250 --top-ks 3,5,10
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+
+from benchmark_utils import parse_ints, percentile
+from context_packer import estimate_tokens, pack_context
+from helpers import (DOC_EXTENSIONS,
+                     EMBEDDING_MODEL,
+                     EMBEDDING_DIMENSION,
+                     CONTEXT_TOKEN_BUDGET,
+                     chunk_text,
+                     extract_full_text,
+                     get_embeddings)
+from memory_store import MemoryIndex
+
+EMBED_BATCH_SIZE = 100
+
+
+class SweepEmbeddingCache:
+    """
+    Embeddings persisted to a single JSON file, keyed by a hash of model,
+    dimension and text. Unlike blob_store.EmbeddingCache it is not tied to a
+    stored document, so one file serves every document of a sweep.
+    """
+
+    def __init__(self, path, model, dimension):
+        self.path = path
+        self.model = model
+        self.dimension = dimension
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model}:{self.dimension}:{text}".encode("utf-8")).hexdigest()
+
+    def embed(self, texts):
+        keys = [self._key(text) for text in texts]
+        missing = list(dict.fromkeys((key, text) for key, text in zip(keys, texts) if key not in self.entries))
+        for start in range(0, len(missing), EMBED_BATCH_SIZE):
+            batch = missing[start:start + EMBED_BATCH_SIZE]
+            for (key, _), embedding in zip(batch, get_embeddings([text for _, text in batch], self.model, self.dimension)):
+                self.entries[key] = embedding
+        return [self.entries[key] for key in keys]
+
+    def save(self):
+        if self.path:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+
+
+def load_documents(documents_dir):
+    documents = {}
+    for file_name in sorted(os.listdir(documents_dir)):
+        if os.path.splitext(file_name)[1].lower() in DOC_EXTENSIONS:
+            documents[file_name] = extract_full_text(os.path.join(documents_dir, file_name))
+    return documents
+
+
+def is_relevant(question, metadata):
+    sources = question.get("sources") or [question.get("source")]
+    if metadata.get("source") not in sources:
+        return False
+    answer = question.get("answer")
+    return not answer or answer.lower() in metadata.get("content", "").lower()
+
+
+def evaluate(documents, questions, question_embeddings, cache, chunk_size, overlap, top_ks):
+    index = MemoryIndex(cache.dimension)
+    chunk_count = 0
+    embedding_tokens = 0
+    for file_name, text in documents.items():
+        chunks = chunk_text(text, chunk_size, overlap)
+        chunk_count += len(chunks)
+        embedding_tokens += sum(estimate_tokens(chunk) for chunk in chunks)
+        index.upsert(vectors=[
+            {"id": f"{file_name}-text-{i}", "values": embedding,
+             "metadata": {"content": chunk, "source": file_name, "file_path": file_name, "type": "text", "chunk_index": i}}
+            for i, (chunk, embedding) in enumerate(zip(chunks, cache.embed(chunks)))
+        ], namespace="docs")
+
+    results = []
+    for top_k in top_ks:
+        reciprocal_ranks = []
+        hits = 0
+        latencies = []
+        context_tokens = []
+        for question, embedding in zip(questions, question_embeddings):
+            started = time.perf_counter()
+            matches = index.query(vector=embedding, top_k=top_k, namespace="docs", include_metadata=True)["matches"]
+            latencies.append((time.perf_counter() - started) * 1000)
+            retrieved = [{**match["metadata"], "score": match["score"]} for match in matches]
+            rank = next((i + 1 for i, metadata in enumerate(retrieved) if is_relevant(question, metadata)), None)
+            hits += rank is not None
+            reciprocal_ranks.append(1 / rank if rank else 0.0)
+            context_tokens.append(pack_context(retrieved, CONTEXT_TOKEN_BUDGET)[1]["packed_tokens"])
+
+        results.append({
+            "chunk_size": chunk_size,
+            "overlap": overlap,
+            "top_k": top_k,
+            "recall_at_k": round(hits / len(questions), 4),
+            "mrr": round(sum(reciprocal_ranks) / len(questions), 4),
+            "vectors_per_doc": round(chunk_count / max(1, len(documents)), 2),
+            "embedding_tokens": embedding_tokens,
+            "context_tokens": round(sum(context_tokens) / len(questions), 1),
+            "latency_ms": round(sum(latencies) / len(latencies), 3),
+            "p95_latency_ms": round(percentile(latencies, 0.95), 3),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep chunking and retrieval settings against a labeled question set.")
+    parser.add_argument("questions", help="JSON file of labeled questions.")
+    parser.add_argument("documents", help="Directory of documents to chunk and embed.")
+    parser.add_argument("--chunk-sizes", type=parse_ints, default=[250, 500, 1000])
+    parser.add_argument("--overlaps", type=parse_ints, default=[0, 125, 250])
+    parser.add_argument("--top-ks", type=parse_ints, default=[3, 5, 10])
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--dimension", type=int, default=EMBEDDING_DIMENSION)
+    parser.add_argument("--cache", default="sweep_embeddings.json", help="Embedding cache file ('' to disable).")
+    parser.add_argument("--output", help="Write the results to a .json or .csv file.")
+    args = parser.parse_args()
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = json.load(f)
+    if not questions:
+        raise SystemExit("The question file is empty.")
+    documents = load_documents(args.documents)
+    if not documents:
+        raise SystemExit(f"No supported documents found in {args.documents}.")
+
+    cache = SweepEmbeddingCache(args.cache, args.model, args.dimension)
+    results = []
+    try:
+        question_embeddings = cache.embed([question["question"] for question in questions])
+        for chunk_size in args.chunk_sizes:
+            for overlap in args.overlaps:
+                if overlap >= chunk_size:
+                    continue
+                results += evaluate(documents, questions, question_embeddings, cache, chunk_size, overlap, args.top_ks)
+                print(f"Evaluated chunk_size={chunk_size}, overlap={overlap}")
+    finally:
+        cache.save()
+
+    columns = list(results[0]) if results else []
+    print("\t".join(columns))
+    for result in sorted(results, key=lambda r: (-r["recall_at_k"], -r["mrr"], r["embedding_tokens"])):
+        print("\t".join(str(result[column]) for column in columns))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="") as f:
+            if args.output.endswith(".csv"):
+                writer = csv.DictWriter(f, fieldnames=columns)
+                writer.writeheader()
+                writer.writerows(results)
+            else:
+                json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Conversation history per browser session, kept in SQLite instead of process
+memory.
+
+Every worker process (and every host sharing the database file) reads and
+writes the same store, so a conversation continues no matter which worker
+answers the next request, and users never see each other's history. Each
+session is identified by the random id stored in its Flask session cookie.
+
+The database lives at SESSION_DB_PATH (by default sessions.sqlite3 in the
+CACHE_ROOT folder, outside the served uploads folder) and uses write-ahead
+logging so readers do not block the writer.
+"""
+import os
+import time
+
+import sqlite_store
+from helpers import CACHE_FOLDER
+
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", os.path.join(CACHE_FOLDER, "sessions.sqlite3"))
+# Messages of sessions idle for longer than this are removed by prune_sessions().
+SESSION_MAX_AGE_DAYS = int(os.getenv("SESSION_MAX_AGE_DAYS", 30))
+
+
+SESSIONS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS messages_by_session ON messages (session_id, id)",
+]
+
+
+def _connect():
+    return sqlite_store.connect(SESSION_DB_PATH, SESSIONS_SCHEMA)
+
+
+def load_messages(session_id):
+    """Returns the session's messages, oldest first, as dictionaries with role and content."""
+    connection = _connect()
+    try:
+        rows = connection.execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id", (session_id,)
+        ).fetchall()
+    finally:
+        connection.close()
+    return [{"role": role, "content": content} for role, content in rows]
+
+
+def append_messages(session_id, messages):
+    """Appends (role, content) pairs to the session's history in one transaction."""
+    now = time.time()
+    connection = _connect()
+    try:
+        with connection:
+            connection.executemany(
+                "INSERT INTO messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                [(session_id, role, content, now) for role, content in messages]
+            )
+    finally:
+        connection.close()
+
+
+def clear_messages(session_id):
+    connection = _connect()
+    try:
+        with connection:
+            connection.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+    finally:
+        connection.close()
+
+
+def prune_sessions(max_age_days=SESSION_MAX_AGE_DAYS):
+    """Deletes the history of sessions with no new message in `max_age_days`. Returns the rows removed."""
+    cutoff = time.time() - max_age_days * 24 * 3600
+    connection = _connect()
+    try:
+        with connection:
+            return connection.execute("""
+                DELETE FROM messages WHERE session_id IN (
+                    SELECT session_id FROM messages GROUP BY session_id HAVING MAX(created_at) < ?
+                )
+            """, (cutoff,)).rowcount
+    finally:
+        connection.close()
@@ -0,0 +1,36 @@
+"""
+Connections to the SQLite databases that worker processes share (see
+session_store.py and migration_store.py).
+
+Each database uses write-ahead logging so readers do not block the writer,
+and waits up to SQLITE_TIMEOUT seconds for another process's write lock.
+"""
+import os
+import sqlite3
+import threading
+
+SQLITE_TIMEOUT = 30
+
+_initialized = set()
+_initialized_lock = threading.Lock()
+
+
+def connect(path, schema):
+    """
+    Opens a connection to the database at `path` for the calling thread. The
+    first connection in a process creates the folder and runs the `schema`
+    statements, which must be idempotent (CREATE ... IF NOT EXISTS).
+    """
+    with _initialized_lock:
+        initialized = path in _initialized
+    if not initialized:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+    if not initialized:
+        with connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in schema:
+                connection.execute(statement)
+        with _initialized_lock:
+            _initialized.add(path)
+    return connection
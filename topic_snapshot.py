@@ -0,0 +1,230 @@
+"""
+Exports a topic to a single snapshot archive and imports it again, so a
+topic can be moved between environments without re-uploading its files or
+paying for its embeddings and image descriptions a second time.
+
+A snapshot is a zip archive containing:
+    manifest.json   topic name, description, embedding model, vector count, dimension and dtype
+    toc.json        the topic's table-of-contents embedding and metadata
+    vectors.jsonl   one {"id", "metadata"} record per vector
+    vectors.bin     the vector values, packed little-endian float32 or float16
+    files/...       the topic's upload directory (document references, alt maps)
+    blobs/...       the stored documents the topic refers to, with their images
+
+Usage:
+    python topic_snapshot.py export <topic> <archive.zip> [--dtype float16]
+    python topic_snapshot.py import <archive.zip> [<topic>]
+"""
+import argparse
+import json
+import os
+import struct
+import tempfile
+import zipfile
+
+from helpers import UPLOAD_FOLDER
+from blob_store import BLOB_FOLDER, REFERENCE_FILE, ALT_MAP_FILE, EXTRACT_LOCK_FILE
+from pinecone_utils import vector_store_manager
+
+SNAPSHOT_FORMAT = 1
+DTYPE_CODES = {"float32": "f", "float16": "e"}
+
+
+def _to_portable_path(path, topic):
+    """
+    Splits a stored file path into the directory it is relative to ("topic"
+    or "blob") and the rest of the path, e.g. ("blob", "<sha>/images/x.jpg").
+    Returns (None, path) for paths outside of both.
+    """
+    path = path.replace("\\", "/")
+    for kind, root in (("topic", os.path.join(UPLOAD_FOLDER, topic)), ("blob", BLOB_FOLDER)):
+        prefix = root.replace("\\", "/") + "/"
+        if path.startswith(prefix):
+            return kind, path[len(prefix):]
+    return None, path
+
+
+def _from_portable_path(kind, relative_path, topic):
+    root = os.path.join(UPLOAD_FOLDER, topic) if kind == "topic" else BLOB_FOLDER
+    return os.path.join(root, *relative_path.split("/"))
+
+
+def _portable_json(data, path_key, topic):
+    """Makes the `path_key` of each entry portable, marking it with the directory it belongs to."""
+    entries = data if isinstance(data, list) else [data]
+    for entry in entries:
+        kind, entry[path_key] = _to_portable_path(entry.get(path_key, ""), topic)
+        if kind:
+            entry["relocate"] = kind
+    return data
+
+
+def _restored_json(data, path_key, topic):
+    entries = data if isinstance(data, list) else [data]
+    for entry in entries:
+        kind = entry.pop("relocate", None)
+        if kind:
+            entry[path_key] = _from_portable_path(kind, entry[path_key], topic)
+    return data
+
+
+def _add_directory(archive, directory, archive_prefix, topic, referenced_blobs=None):
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            if file_name == EXTRACT_LOCK_FILE:
+                continue
+            full_path = os.path.join(root, file_name)
+            name = f"{archive_prefix}/{os.path.relpath(full_path, directory).replace(os.sep, '/')}"
+            if file_name in (ALT_MAP_FILE, REFERENCE_FILE):
+                with open(full_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if file_name == REFERENCE_FILE and referenced_blobs is not None:
+                    referenced_blobs.add(data["sha256"])
+                archive.writestr(name, json.dumps(_portable_json(data, "path", topic), indent=4))
+            else:
+                archive.write(full_path, name)
+
+
+def export_topic(topic, archive_path, dtype="float32"):
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported dtype '{dtype}', expected one of {list(DTYPE_CODES)}.")
+    if topic not in vector_store_manager.list_indexes():
+        raise ValueError(f"Topic '{topic}' does not exist.")
+
+    toc_values, toc_metadata = vector_store_manager.get_index_entry(topic)
+    spec = vector_store_manager.get_topic_spec(topic)
+    topic_dir = os.path.join(UPLOAD_FOLDER, topic)
+    count = 0
+    dimension = spec["dimension"]
+
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive, tempfile.TemporaryDirectory() as staging:
+        # zipfile only allows one open write handle, so both vector files are staged first.
+        values_path = os.path.join(staging, "vectors.bin")
+        records_path = os.path.join(staging, "vectors.jsonl")
+        with open(values_path, "wb") as values_file, open(records_path, "w", encoding="utf-8") as records_file:
+            for vector_id, values, metadata in vector_store_manager.export_vectors(topic):
+                record = {"id": vector_id, "metadata": metadata}
+                kind, metadata["file_path"] = _to_portable_path(metadata.get("file_path", ""), topic)
+                if kind:
+                    record["relocate"] = kind
+                values_file.write(struct.pack(f"<{dimension}{DTYPE_CODES[dtype]}", *values))
+                records_file.write(json.dumps(record) + "\n")
+                count += 1
+        archive.write(values_path, "vectors.bin", compress_type=zipfile.ZIP_STORED)
+        archive.write(records_path, "vectors.jsonl")
+
+        referenced_blobs = set()
+        _add_directory(archive, topic_dir, "files", topic, referenced_blobs)
+        for sha in sorted(referenced_blobs):
+            _add_directory(archive, os.path.join(BLOB_FOLDER, sha), f"blobs/{sha}", topic)
+
+        archive.writestr("toc.json", json.dumps({"values": toc_values, "metadata": toc_metadata}))
+        archive.writestr("manifest.json", json.dumps({
+            "format": SNAPSHOT_FORMAT,
+            "topic": topic,
+            "description": toc_metadata.get("description", ""),
+            "embedding_model": spec["embedding_model"],
+            "count": count,
+            "dimension": dimension,
+            "dtype": dtype,
+        }, indent=4))
+    return count
+
+
+def _read_vectors(archive, manifest, topic):
+    code = DTYPE_CODES[manifest["dtype"]]
+    dimension = manifest["dimension"]
+    record_size = struct.calcsize(f"<{dimension}{code}")
+    with archive.open("vectors.bin") as values_file, archive.open("vectors.jsonl") as records_file:
+        for line in records_file:
+            record = json.loads(line)
+            values = list(struct.unpack(f"<{dimension}{code}", values_file.read(record_size)))
+            if record.get("relocate"):
+                record["metadata"]["file_path"] = _from_portable_path(record["relocate"], record["metadata"]["file_path"], topic)
+            yield record["id"], values, record["metadata"]
+
+
+def _discard_topic(topic):
+    """Removes whatever part of a failed import was already created."""
+    try:
+        vector_store_manager.delete_index(topic)
+    except Exception as e:
+        print(f"Could not fully remove the partially imported topic '{topic}': {e}")
+
+
+def import_topic(archive_path, topic=None):
+    """Restores a snapshot into a new topic (by default, the topic it was exported from)."""
+    with zipfile.ZipFile(archive_path) as archive:
+        manifest = json.loads(archive.read("manifest.json"))
+        if manifest.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"Unsupported snapshot format: {manifest.get('format')}")
+        topic = topic or manifest["topic"]
+        if topic in vector_store_manager.list_indexes():
+            raise ValueError(f"Topic '{topic}' already exists.")
+
+        targets = {}
+        for name in archive.namelist():
+            if name.endswith("/"):
+                continue
+            kind, _, relative_path = name.partition("/")
+            if kind not in ("files", "blobs"):
+                continue
+            root = os.path.abspath(os.path.join(UPLOAD_FOLDER, topic) if kind == "files" else BLOB_FOLDER)
+            target = os.path.abspath(os.path.join(root, *relative_path.split("/")))
+            if not target.startswith(root + os.sep):
+                raise ValueError(f"Refusing to extract '{name}' outside of the upload folder.")
+            # Blobs already present here are identical by construction.
+            if kind == "blobs" and os.path.isdir(os.path.join(BLOB_FOLDER, relative_path.split("/")[0])):
+                continue
+            targets[name] = target
+
+        toc = json.loads(archive.read("toc.json"))
+        embedding = toc.get("values")
+        # The description vector must match this environment's table of
+        # contents; if it does not, create_index() embeds the description anew.
+        if not embedding or len(embedding) != vector_store_manager.toc_dimension:
+            embedding = None
+        try:
+            vector_store_manager.create_index(topic, manifest.get("description", ""), manifest["embedding_model"],
+                                              manifest["dimension"], embedding=embedding)
+            for name, target in targets.items():
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if os.path.basename(name) in (ALT_MAP_FILE, REFERENCE_FILE):
+                    data = _restored_json(json.loads(archive.read(name)), "path", topic)
+                    with open(target, "w", encoding="utf-8") as f:
+                        json.dump(data, f, indent=4)
+                else:
+                    with archive.open(name) as source, open(target, "wb") as f:
+                        f.write(source.read())
+
+            count = 0
+            if manifest["count"]:
+                count = vector_store_manager.import_vectors(topic, _read_vectors(archive, manifest, topic))
+        except Exception:
+            _discard_topic(topic)
+            raise
+    return topic, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import topic snapshots.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="Write a topic to a snapshot archive.")
+    export_parser.add_argument("topic")
+    export_parser.add_argument("archive")
+    export_parser.add_argument("--dtype", choices=list(DTYPE_CODES), default="float32")
+    import_parser = commands.add_parser("import", help="Restore a snapshot archive as a new topic.")
+    import_parser.add_argument("archive")
+    import_parser.add_argument("topic", nargs="?")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        count = export_topic(args.topic, args.archive, args.dtype)
+        print(f"Exported {count} vectors from '{args.topic}' to {args.archive}.")
+    else:
+        topic, count = import_topic(args.archive, args.topic)
+        print(f"Imported {count} vectors into '{topic}'.")
+
+
+if __name__ == "__main__":
+    main()